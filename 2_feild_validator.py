@@ -1,6 +1,10 @@
-from pydantic import BaseModel, EmailStr, AnyUrl, Field, field_validator
+from pydantic import BaseModel, EmailStr, AnyUrl, Field, TypeAdapter, field_validator
 from typing import List, Dict, Optional, Annotated
 
+# the allowed email domains are built once when the module is loaded, not again on every validation,
+# and a frozenset checks membership with one hash lookup instead of comparing against every domain in a list
+VALID_DOMAINS = frozenset({'hdfc.com', 'icici.com'})
+
 class Patient(BaseModel):
 
     name: str
@@ -17,10 +21,10 @@ class Patient(BaseModel):
     @classmethod  # this line tells that the method is a class method and not an instance method
     def email_validator(cls, value):
 
-        valid_domains = ['hdfc.com', 'icici.com']
-        domain_name = value.split('@')[-1]
+        # rpartition splits only once at the last '@', split('@') would build a list of every part
+        domain_name = value.rpartition('@')[2]
         # Check if the email domain is either hdfc.com or icici.com
-        if domain_name not in valid_domains:
+        if domain_name not in VALID_DOMAINS:
             raise ValueError("Not a valid domain, Email must belong to either hdfc.com or icici.com")
         return value
 
@@ -58,3 +62,14 @@ patient_info = {'name':'nitish', 'email':'abc@icici.com', 'age': '30', 'weight':
 patient1 = Patient(**patient_info) # validation -> type coercion
 
 update_patient_data(patient1)
+
+
+# when many patients have to be validated at once, calling Patient(**info) in a loop validates them one by one,
+# a TypeAdapter for List[Patient] validates the whole list in a single call (build it once and reuse it,
+# creating the adapter is the expensive part). strict=True skips type coercion, so an age of '30' would be rejected
+patients_adapter = TypeAdapter(List[Patient])
+
+patients = patients_adapter.validate_python([patient_info, {**patient_info, 'name': 'rahul', 'email': 'rahul@hdfc.com'}])
+
+for patient in patients:
+    update_patient_data(patient)
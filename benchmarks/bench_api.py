@@ -0,0 +1,192 @@
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from datagen import generate_patient_body, write_dataset
+from timing import measure_async, summarize
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+
+# end-to-end benchmarks of the patient API on synthetic data sets (1k, 100k and 1M patients by default).
+# every endpoint is timed with sequential requests (latency) and with concurrent clients (throughput),
+# either against the app in-process through httpx's ASGI transport or against a local uvicorn server.
+#
+#     python benchmarks/bench_api.py --sizes 1000 100000 --transport asgi uvicorn --output api.json
+#
+# the response cache is switched off unless --response-cache is given, so repeated GETs measure the real work.
+
+
+def import_app(data_path):
+    os.environ['PATIENT_STORAGE'] = 'json'
+    os.environ['PATIENT_DATA_PATH'] = str(data_path)
+    if 'main' in sys.modules:
+        sys.modules['main'].store.close()
+        return importlib.reload(sys.modules['main'])
+    return importlib.import_module('main')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_uvicorn(data_path, env_extra):
+    port = free_port()
+    env = dict(os.environ, PATIENT_STORAGE='json', PATIENT_DATA_PATH=str(data_path), **env_extra)
+    process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port), '--log-level', 'warning'],
+                               cwd=REPO, env=env)
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 600
+    while time.monotonic() < deadline:
+        try:
+            # /ready rather than /status, the server accepts requests before the data has been loaded
+            if httpx.get(url + '/ready').status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        # also after a 503 while the data is loading, polling in a tight loop would slow the load down
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('uvicorn did not start')
+
+
+def endpoint_requests(model, patient_ids, rng):
+    counter = iter(range(10 ** 9))
+
+    def edit_body():
+        body = generate_patient_body(model, 'unused', rng)
+        del body['id']
+        return body
+
+    return {
+        'view_full': lambda client: client.get('/view'),
+        'view_page': lambda client: client.get('/view', params={'limit': 50}),
+        'get_by_id': lambda client: client.get(f'/patient/{rng.choice(patient_ids)}'),
+        'sort_top10': lambda client: client.get('/sort', params={'sort_by': 'bmi', 'order': 'desc', 'limit': 10}),
+        'sort_full': lambda client: client.get('/sort', params={'sort_by': 'bmi'}),
+        'create': lambda client: client.post('/create_patient', json=generate_patient_body(model, f'NEW{next(counter)}', rng)),
+        'edit': lambda client: client.put(f'/edit_patient/{rng.choice(patient_ids)}', json=edit_body()),
+    }
+
+
+# full-data-set endpoints get fewer repetitions on big data sets so a run stays in minutes
+def repetitions(name, size, repeat):
+    if name in ('view_full', 'sort_full'):
+        return max(3, min(repeat, 2_000_000 // size))
+    return repeat
+
+
+async def check(response):
+    response = await response
+    if response.status_code >= 400:
+        raise RuntimeError(f'{response.request.method} {response.request.url} -> {response.status_code}')
+
+
+async def run_suite(client, requests, size, repeat, concurrency):
+    latency, throughput = {}, {}
+    for name, request in requests.items():
+        count = repetitions(name, size, repeat)
+        latency[name] = await measure_async(lambda: check(request(client)), repeat=count, warmup=min(5, count))
+
+        # throughput: `concurrency` clients share `count` requests
+        remaining = iter(range(count))
+        durations = []
+
+        async def worker():
+            for _ in remaining:
+                started = time.perf_counter()
+                await check(request(client))
+                durations.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        throughput[name] = summarize(durations, elapsed=time.perf_counter() - started)
+    return {'latency': latency, 'throughput': throughput}
+
+
+async def bench_size(size, transports, repeat, concurrency, response_cache, workdir):
+    data_path = Path(workdir) / f'patients_{size}.json'
+    # the model comes from main itself, imported against an empty data file so the real patients.json is not loaded
+    model = import_app(Path(workdir) / 'empty.json').Patient
+    write_dataset(model, size, data_path)
+    patient_ids = list(json.load(open(data_path)))
+    results = []
+
+    for transport in transports:
+        # every transport starts from the same freshly generated data
+        write_dataset(model, size, data_path)
+        for leftover in (data_path.with_name(data_path.name + '.log'), data_path.with_name(data_path.name + '.log.1')):
+            leftover.unlink(missing_ok=True)
+        rng = random.Random(size)
+        requests = endpoint_requests(model, patient_ids, rng)
+
+        if transport == 'asgi':
+            started = time.perf_counter()
+            app_module = import_app(data_path)
+            load_s = time.perf_counter() - started
+            if not response_cache:
+                app_module.response_cache.max_bytes = 0
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app_module.app), base_url='http://bench', timeout=600) as client:
+                suite = await run_suite(client, requests, size, repeat, concurrency)
+        else:
+            env_extra = {} if response_cache else {'PATIENT_RESPONSE_CACHE_BYTES': '0'}
+            started = time.perf_counter()
+            process, url = start_uvicorn(data_path, env_extra)
+            load_s = time.perf_counter() - started
+            try:
+                limits = httpx.Limits(max_connections=concurrency)
+                async with httpx.AsyncClient(base_url=url, timeout=600, limits=limits) as client:
+                    suite = await run_suite(client, requests, size, repeat, concurrency)
+            finally:
+                process.terminate()
+                process.wait()
+
+        results.append({'size': size, 'transport': transport, 'startup_s': round(load_s, 3), **suite})
+    return results
+
+
+async def run(sizes, transports, repeat, concurrency, response_cache):
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            results += await bench_size(size, transports, repeat, concurrency, response_cache, workdir)
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='End-to-end benchmarks for the patient API')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 100_000, 1_000_000])
+    parser.add_argument('--transport', nargs='+', choices=['asgi', 'uvicorn'], default=['asgi', 'uvicorn'])
+    parser.add_argument('--repeat', type=int, default=200, help='requests per endpoint and phase')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--response-cache', action='store_true', help='keep the HTTP response cache enabled')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = asyncio.run(run(args.sizes, args.transport, args.repeat, args.concurrency, args.response_cache))
+    payload = json.dumps({'benchmark': 'api', 'results': results}, indent=2)
+    if args.output:
+        Path(args.output).write_text(payload)
+    else:
+        print(payload)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+from bench_models import load_patient_model
+from datagen import generate_patients
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+from columnar import PatientTable  # noqa: E402
+from patient_store import PatientStore  # noqa: E402
+
+
+# resident memory per patient of the different ways the app can hold the data set:
+#   dict_records      - {id: record} as json.load returns it, what PatientStore keeps by default
+#   columnar_table    - the same data in a PatientTable (columnar.py), what PATIENT_COMPACT=1 keeps
+#   patient_instances - one validated main.Patient per patient, with bmi and verdict cached
+#   store_dict / store_compact - a whole PatientStore loaded from patients.json, indexes included
+#
+#     python benchmarks/bench_memory.py --count 100000 --output memory.json
+#
+# sizes are measured with tracemalloc, so they count every object the structure keeps alive.
+
+
+def traced_bytes(build):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        kept = build()
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del kept
+    return size
+
+
+def run(count):
+    Patient = load_patient_model()
+    text = json.dumps(generate_patients(Patient, count))
+
+    def columnar_table():
+        data = json.loads(text)
+        table = PatientTable(data)
+        del data
+        return table
+
+    def patient_instances():
+        instances = [Patient(id=patient_id, **record) for patient_id, record in json.loads(text).items()]
+        for patient in instances:
+            patient.bmi, patient.verdict
+        return instances
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'patients.json')
+        Path(path).write_text(text)
+
+        def store(compact):
+            patient_store = PatientStore(path, check_interval=None, compact=compact)
+            patient_store.close()
+            return patient_store
+
+        sizes = {
+            'dict_records': traced_bytes(lambda: json.loads(text)),
+            'columnar_table': traced_bytes(columnar_table),
+            'patient_instances': traced_bytes(patient_instances),
+            'store_dict': traced_bytes(lambda: store(False)),
+            'store_compact': traced_bytes(lambda: store(True)),
+        }
+    return {name: {'bytes': size, 'bytes_per_patient': round(size / count, 1)} for name, size in sizes.items()}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Memory per patient of the in-memory representations')
+    parser.add_argument('--count', type=int, default=100_000)
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    payload = json.dumps({'benchmark': 'memory', 'count': args.count, 'results': run(args.count)}, indent=2)
+    if args.output:
+        Path(args.output).write_text(payload)
+    else:
+        print(payload)
+
+
+if __name__ == '__main__':
+    main()
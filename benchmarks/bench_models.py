@@ -0,0 +1,134 @@
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+from pathlib import Path
+
+from pydantic import TypeAdapter
+
+from datagen import generate_patient_body
+from timing import measure
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO))
+
+
+# micro-benchmarks for the pydantic models: main.Patient validation and serialisation,
+# the validators of the tutorial scripts 2_feild_validator.py and 3_model_validator.py,
+# and records per second of one-by-one versus batch validation (validation.py).
+#
+#     python benchmarks/bench_models.py --repeat 20000 --output models.json
+
+
+# the tutorial scripts have names that cannot be imported normally and print while they run, load them quietly
+def load_script(filename):
+    spec = importlib.util.spec_from_file_location(Path(filename).stem.lstrip('0123456789_'), REPO / filename)
+    module = importlib.util.module_from_spec(spec)
+    with contextlib.redirect_stdout(io.StringIO()):
+        spec.loader.exec_module(module)
+    return module
+
+
+def load_patient_model():
+    # point the app at a data file that does not exist, importing main must not load the real patients.json
+    os.environ['PATIENT_STORAGE'] = 'json'
+    os.environ['PATIENT_DATA_PATH'] = os.path.join(tempfile.mkdtemp(), 'empty.json')
+    import main
+    return main.Patient
+
+
+def bench_main_patient(repeat):
+    Patient = load_patient_model()
+    rng = random.Random(1)
+    bodies = [generate_patient_body(Patient, f'P{i}', rng) for i in range(1000)]
+    instances = [Patient(**body) for body in bodies]
+    for patient in instances:
+        patient.bmi, patient.verdict  # fill the cached derived fields
+    json_bodies = [json.dumps(body) for body in bodies]
+    list_adapter = TypeAdapter(list[Patient])
+    cycle = iter(range(10 ** 12))
+
+    def nth(items):
+        return items[next(cycle) % len(items)]
+
+    return {
+        'patient_init_kwargs': measure(lambda: Patient(**nth(bodies)), repeat),
+        'patient_model_validate': measure(lambda: Patient.model_validate(nth(bodies)), repeat),
+        'patient_model_validate_json': measure(lambda: Patient.model_validate_json(nth(json_bodies)), repeat),
+        'patient_model_dump': measure(lambda: nth(instances).model_dump(), repeat),
+        'patient_model_dump_exclude_id': measure(lambda: nth(instances).model_dump(exclude=['id']), repeat),
+        'patient_model_dump_json': measure(lambda: nth(instances).model_dump_json(), repeat),
+        'patient_fresh_bmi_verdict': measure(lambda: Patient(**nth(bodies)).verdict, repeat),
+        # one call validates 1000 patients, ops_per_s is batches per second
+        'patient_list_adapter_1000': measure(lambda: list_adapter.validate_python(bodies), max(10, repeat // 1000), warmup=2),
+    }
+
+
+def bench_tutorial_validators(repeat):
+    field_validator = load_script('2_feild_validator.py')
+    model_validator = load_script('3_model_validator.py')
+    base = {'name': 'nitish', 'email': 'abc@icici.com', 'age': '30', 'weight': 75.2, 'married': True,
+            'allergies': ['pollen', 'dust'], 'contact_details': {'phone': '2353462'}}
+    senior = dict(base, age='65', contact_details={'phone': '2353462', 'emergency': '235236'})
+
+    return {
+        'field_validator_patient': measure(lambda: field_validator.Patient(**base), repeat),
+        'field_validator_email_validator': measure(lambda: field_validator.Patient.email_validator('abc@icici.com'), repeat),
+        'model_validator_patient': measure(lambda: model_validator.Patient(**senior), repeat),
+    }
+
+
+# every entry validates the same `count` records, records_per_s is count times the batches per second
+def bench_validation(count=10_000, repeat=5):
+    from validation import construct_many, validate_many
+
+    Patient = load_patient_model()
+    field_validator = load_script('2_feild_validator.py')
+    rng = random.Random(2)
+    patients = [generate_patient_body(Patient, f'P{i}', rng) for i in range(count)]
+    tutorial = [{'name': f'patient{i}', 'email': f'p{i}@icici.com', 'age': 30 + i % 40, 'weight': 75.2, 'married': True,
+                 'allergies': ['pollen'], 'contact_details': {'phone': '2353462'}} for i in range(count)]
+
+    def records_per_s(fn):
+        summary = measure(fn, repeat, warmup=1)
+        summary['records_per_s'] = round(summary['ops_per_s'] * count, 1) if summary['ops_per_s'] else None
+        return summary
+
+    return {
+        'validation_patient_single': records_per_s(lambda: [Patient(**body) for body in patients]),
+        'validation_patient_batch': records_per_s(lambda: validate_many(Patient, patients)),
+        'validation_patient_batch_strict': records_per_s(lambda: validate_many(Patient, patients, strict=True)),
+        'validation_patient_construct': records_per_s(lambda: construct_many(Patient, patients)),
+        'validation_field_validator_single': records_per_s(lambda: [field_validator.Patient(**body) for body in tutorial]),
+        'validation_field_validator_batch': records_per_s(lambda: validate_many(field_validator.Patient, tutorial)),
+        'validation_field_validator_construct': records_per_s(lambda: construct_many(field_validator.Patient, tutorial)),
+    }
+
+
+def run(repeat):
+    return {**bench_main_patient(repeat), **bench_tutorial_validators(repeat), **bench_validation()}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the pydantic models')
+    parser.add_argument('--repeat', type=int, default=20000)
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    payload = json.dumps({'benchmark': 'models', 'results': run(args.repeat)}, indent=2)
+    if args.output:
+        Path(args.output).write_text(payload)
+    else:
+        print(payload)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from bench_models import load_patient_model
+from datagen import write_dataset
+
+REPO = Path(__file__).resolve().parent.parent
+
+
+# cold start of the app, every measurement runs in a fresh interpreter so nothing is already imported or parsed:
+#   import_main       - `import main` with the default PATIENT_LOAD=background, the data is not read yet
+#   eager_import      - `import main` with PATIENT_LOAD=eager, the data is loaded during the import as before
+#   ready_cold        - import plus background load until the store is ready, without patients.json.bin
+#   ready_warm        - the same with the patients.json.bin cache that the cold start left behind
+#   openapi_first     - the first app.openapi() call, FastAPI builds the schema on the first /openapi.json only
+#
+#     python benchmarks/bench_startup.py --count 100000 --repeat 3 --output startup.json
+
+CHILD = '''
+import asyncio, json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+if sys.argv[1] == 'ready':
+    async def ready():
+        async with main.lifespan(main.app):
+            await main.wait_for_store()
+    asyncio.run(ready())
+openapi_start = time.perf_counter()
+main.app.openapi()
+print(json.dumps({'import_s': imported - start, 'ready_s': openapi_start - start,
+                  'openapi_s': time.perf_counter() - openapi_start, 'patients': len(main.store) if main.store.loaded else None}))
+main.store.close()
+'''
+
+
+def measure(data_path, mode, load):
+    env = dict(os.environ, PATIENT_STORAGE='json', PATIENT_DATA_PATH=str(data_path), PATIENT_LOAD=load, PATIENT_SHARDS='1')
+    output = subprocess.run([sys.executable, '-c', CHILD, mode], cwd=REPO, env=env, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def summary(samples, key):
+    values = sorted(sample[key] for sample in samples)
+    return {'min_ms': round(values[0] * 1000, 1), 'median_ms': round(values[len(values) // 2] * 1000, 1)}
+
+
+def run(count, repeat=3):
+    with tempfile.TemporaryDirectory() as directory:
+        data_path = Path(directory) / 'patients.json'
+        write_dataset(load_patient_model(), count, data_path)
+        binary_path = Path(str(data_path) + '.bin')
+
+        import_main = [measure(data_path, 'import', 'background') for _ in range(repeat)]
+        eager = [measure(data_path, 'import', 'eager') for _ in range(repeat)]
+        cold = []
+        for _ in range(repeat):
+            binary_path.unlink(missing_ok=True)
+            cold.append(measure(data_path, 'ready', 'background'))
+        warm = [measure(data_path, 'ready', 'background') for _ in range(repeat)]
+
+    return {
+        'import_main': summary(import_main, 'import_s'),
+        'eager_import': summary(eager, 'import_s'),
+        'ready_cold': summary(cold, 'ready_s'),
+        'ready_warm': summary(warm, 'ready_s'),
+        'openapi_first': summary(import_main, 'openapi_s'),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Startup time of the app in fresh processes')
+    parser.add_argument('--count', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    payload = json.dumps({'benchmark': 'startup', 'count': args.count, 'results': run(args.count, args.repeat)}, indent=2)
+    if args.output:
+        Path(args.output).write_text(payload)
+    else:
+        print(payload)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import argparse
+import json
+
+
+# compares two result files written by run.py and prints the change of every metric,
+# for latencies lower is better, for ops_per_s higher is better
+#
+#     python benchmarks/compare.py before.json after.json --metric p50_us --threshold 10
+
+
+def flatten(results):
+    rows = {}
+    for name, summary in results.get('models', {}).items():
+        rows[f'models/{name}'] = summary
+    for name, summary in results.get('memory', {}).items():
+        rows[f'memory/{name}'] = summary
+    for name, summary in results.get('startup', {}).items():
+        rows[f'startup/{name}'] = summary
+    for run in results.get('api', []):
+        for phase in ('latency', 'throughput'):
+            for name, summary in run[phase].items():
+                rows[f"api/{run['transport']}/{run['size']}/{phase}/{name}"] = summary
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Diff two benchmark result files')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--metric', default='p50_us', help='summary field to compare, e.g. p50_us, p99_us, ops_per_s, bytes_per_patient or median_ms')
+    parser.add_argument('--threshold', type=float, default=0, help='only show changes larger than this many percent')
+    args = parser.parse_args(argv)
+
+    with open(args.before) as f:
+        before = flatten(json.load(f))
+    with open(args.after) as f:
+        after = flatten(json.load(f))
+
+    higher_is_better = args.metric == 'ops_per_s'
+    regressions = 0
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key].get(args.metric), after[key].get(args.metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        if abs(change) < args.threshold:
+            continue
+        worse = change < 0 if higher_is_better else change > 0
+        regressions += worse
+        print(f"{'REGRESSION' if worse else 'improved  '} {key:70} {old:>12} -> {new:>12} ({change:+.1f}%)")
+    for key in sorted(before.keys() ^ after.keys()):
+        print(f"{'only before' if key in before else 'only after '} {key}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,77 @@
+import json
+import random
+import sys
+import typing
+from functools import lru_cache
+from pathlib import Path
+
+from annotated_types import Ge, Gt, Le, Lt
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from patient_metrics import derived_fields_batch  # noqa: E402
+
+
+# synthetic patients for the benchmarks, generated from the field definitions of main.Patient,
+# so a new field or a changed constraint shows up here without touching this file.
+# the model is passed in, importing main here would already load the real patients.json
+
+CITIES = ['Delhi', 'Mumbai', 'Pune', 'Guwahati', 'Chennai', 'Kolkata', 'Bengaluru', 'Jaipur', 'Lucknow', 'Hyderabad']
+
+# realistic ranges for fields whose constraints alone allow anything above 0
+RANGES = {'age': (1, 99), 'height': (140.0, 200.0), 'weight': (35.0, 140.0)}
+
+
+def _bounds(field_name, field):
+    low, high = RANGES.get(field_name, (0, 1000))
+    for constraint in field.metadata:
+        if isinstance(constraint, (Gt, Ge)):
+            low = max(low, constraint.gt if isinstance(constraint, Gt) else constraint.ge)
+        if isinstance(constraint, (Lt, Le)):
+            high = min(high, constraint.lt if isinstance(constraint, Lt) else constraint.le)
+    return low, high
+
+
+def _value_factory(field_name, field):
+    annotation = field.annotation
+    if typing.get_origin(annotation) is typing.Literal:
+        choices = typing.get_args(annotation)
+        return lambda rng, i: rng.choice(choices)
+    if annotation is int:
+        low, high = _bounds(field_name, field)
+        low, high = int(low) + 1, int(high) - 1
+        return lambda rng, i: rng.randint(low, high)
+    if annotation is float:
+        low, high = _bounds(field_name, field)
+        return lambda rng, i: round(rng.uniform(low, high), 1)
+    if field_name == 'city':
+        return lambda rng, i: rng.choice(CITIES)
+    return lambda rng, i: f'{field_name}-{i}'
+
+
+@lru_cache(maxsize=None)
+def _factories(model):
+    return {name: _value_factory(name, field) for name, field in model.model_fields.items() if name != 'id'}
+
+
+# {id: record} exactly as the store keeps it, including the derived bmi and verdict
+def generate_patients(model, count, seed=42):
+    rng = random.Random(seed)
+    factories = _factories(model)
+    ids = [f'B{i:07d}' for i in range(count)]
+    records = [{name: make(rng, i) for name, make in factories.items()} for i in range(count)]
+    bmis, verdicts = derived_fields_batch([record['height'] for record in records], [record['weight'] for record in records])
+    for record, bmi, verdict in zip(records, bmis, verdicts):
+        record['bmi'] = bmi
+        record['verdict'] = verdict
+    return dict(zip(ids, records))
+
+
+# the request body for POST /create_patient, as a client would send it
+def generate_patient_body(model, patient_id, rng):
+    return {'id': patient_id, **{name: make(rng, 0) for name, make in _factories(model).items()}}
+
+
+def write_dataset(model, count, path, seed=42):
+    with open(path, 'w') as f:
+        json.dump(generate_patients(model, count, seed), f)
@@ -0,0 +1,122 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import httpx
+
+
+# load test for the patient API: N concurrent clients hammer a running server for a fixed time
+# with a read-heavy mix of requests, then throughput and latency percentiles are printed as JSON.
+#
+#     uvicorn main:app --port 8000
+#     python benchmarks/load_test.py --url http://127.0.0.1:8000 --concurrency 1000 --duration 30
+#
+# run it once against the old code and once against the new one to compare the two.
+# the mix only uses URLs that every version of the API understands (extra query parameters are ignored by old ones).
+
+MIX = [
+    (60, 'get'),
+    (15, 'sort'),
+    (10, 'view_page'),
+    (10, 'edit'),
+    (5, 'create'),
+]
+
+PATIENT_BODY = {'name': 'Load Test', 'city': 'Delhi', 'age': 30, 'gender': 'male', 'height': 170.0, 'weight': 70.0}
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def pick_operation(rng):
+    roll = rng.uniform(0, sum(weight for weight, _ in MIX))
+    for weight, name in MIX:
+        roll -= weight
+        if roll <= 0:
+            return name
+    return MIX[-1][1]
+
+
+async def one_request(client, operation, patient_ids, rng, worker, counter):
+    if operation == 'get':
+        return await client.get(f'/patient/{rng.choice(patient_ids)}')
+    if operation == 'sort':
+        return await client.get('/sort', params={'sort_by': rng.choice(['height', 'weight', 'bmi']), 'order': 'desc', 'limit': 10})
+    if operation == 'view_page':
+        return await client.get('/view', params={'limit': 50})
+    if operation == 'edit':
+        body = dict(PATIENT_BODY, weight=round(rng.uniform(40, 120), 1))
+        return await client.put(f'/edit_patient/{rng.choice(patient_ids)}', json=body)
+    counter[0] += 1
+    return await client.post('/create_patient', json=dict(PATIENT_BODY, id=f'LT-{worker}-{counter[0]}-{time.time_ns()}'))
+
+
+async def worker(client, deadline, patient_ids, seed, latencies, statuses):
+    rng = random.Random(seed)
+    counter = [0]
+    while time.perf_counter() < deadline:
+        operation = pick_operation(rng)
+        started = time.perf_counter()
+        try:
+            response = await one_request(client, operation, patient_ids, rng, seed, counter)
+            status = response.status_code
+        except httpx.HTTPError as exc:
+            status = type(exc).__name__
+        latencies.setdefault(operation, []).append(time.perf_counter() - started)
+        statuses[status] = statuses.get(status, 0) + 1
+
+
+# the edit requests need existing ids, seed a set of patients that belong to the load test
+async def seed_patients(client, count):
+    patient_ids = [f'LT-SEED-{i}' for i in range(count)]
+    for patient_id in patient_ids:
+        await client.post('/create_patient', json=dict(PATIENT_BODY, id=patient_id))
+    return patient_ids
+
+
+async def run(url, concurrency, duration, seed_count):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+        patient_ids = await seed_patients(client, seed_count)
+        latencies, statuses = {}, {}
+        started = time.perf_counter()
+        deadline = started + duration
+        await asyncio.gather(*(worker(client, deadline, patient_ids, i, latencies, statuses) for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    all_latencies = sorted(value for values in latencies.values() for value in values)
+    summary = {
+        'url': url,
+        'concurrency': concurrency,
+        'duration_s': round(elapsed, 2),
+        'requests': len(all_latencies),
+        'throughput_rps': round(len(all_latencies) / elapsed, 1),
+        'statuses': {str(status): count for status, count in statuses.items()},
+        'latency_ms': {},
+    }
+    for name, values in [('all', all_latencies)] + sorted(latencies.items()):
+        values = sorted(values)
+        summary['latency_ms'][name] = {
+            'count': len(values),
+            'p50': round(percentile(values, 50) * 1000, 2),
+            'p90': round(percentile(values, 90) * 1000, 2),
+            'p99': round(percentile(values, 99) * 1000, 2),
+        }
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Concurrent load test for the patient API')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--concurrency', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--seed-patients', type=int, default=200)
+    args = parser.parse_args()
+
+    print(json.dumps(asyncio.run(run(args.url, args.concurrency, args.duration, args.seed_patients)), indent=2))
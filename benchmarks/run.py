@@ -0,0 +1,72 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import fastapi
+import pydantic
+
+import bench_api
+import bench_memory
+import bench_models
+import bench_startup
+
+REPO = Path(__file__).resolve().parent.parent
+
+
+# runs the whole benchmark suite and writes one JSON document with enough metadata to compare runs later:
+#
+#     python benchmarks/run.py --output before.json
+#     ... change something ...
+#     python benchmarks/run.py --output after.json
+#     python benchmarks/compare.py before.json after.json
+
+
+def metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_commit': commit or None,
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'fastapi': fastapi.__version__,
+        'pydantic': pydantic.VERSION,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the model and API benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 100_000, 1_000_000])
+    parser.add_argument('--transport', nargs='+', choices=['asgi', 'uvicorn'], default=['asgi', 'uvicorn'])
+    parser.add_argument('--repeat', type=int, default=200, help='requests per endpoint and phase')
+    parser.add_argument('--model-repeat', type=int, default=20000)
+    parser.add_argument('--memory-count', type=int, default=100_000, help='patients in the memory benchmark')
+    parser.add_argument('--startup-count', type=int, default=100_000, help='patients in the startup benchmark')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--response-cache', action='store_true')
+    parser.add_argument('--output', default='bench_output.json')
+    args = parser.parse_args(argv)
+
+    api_args = ['--sizes', *map(str, args.sizes), '--transport', *args.transport, '--repeat', str(args.repeat),
+                '--concurrency', str(args.concurrency)] + (['--response-cache'] if args.response_cache else [])
+    api = bench_api.parse_args(api_args)
+
+    results = {
+        'meta': metadata(),
+        'models': bench_models.run(args.model_repeat),
+        'memory': bench_memory.run(args.memory_count),
+        'startup': bench_startup.run(args.startup_count),
+        'api': bench_api.asyncio.run(bench_api.run(api.sizes, api.transport, api.repeat, api.concurrency, api.response_cache)),
+    }
+    Path(args.output).write_text(json.dumps(results, indent=2))
+    print(f'wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
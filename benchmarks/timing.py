@@ -0,0 +1,47 @@
+import statistics
+import time
+
+
+# shared helpers for the benchmark scripts: run something many times and summarise the timings.
+# all durations in the JSON output are in microseconds so small and large results can be compared directly.
+
+def summarize(durations, elapsed=None):
+    durations = sorted(durations)
+    n = len(durations)
+
+    def pick(q):
+        return durations[min(n - 1, int(round(q / 100 * (n - 1))))]
+
+    summary = {
+        'n': n,
+        'mean_us': round(statistics.fmean(durations) * 1e6, 2),
+        'p50_us': round(pick(50) * 1e6, 2),
+        'p95_us': round(pick(95) * 1e6, 2),
+        'p99_us': round(pick(99) * 1e6, 2),
+        'max_us': round(durations[-1] * 1e6, 2),
+    }
+    total = elapsed if elapsed is not None else sum(durations)
+    summary['ops_per_s'] = round(n / total, 1) if total else None
+    return summary
+
+
+def measure(fn, repeat=1000, warmup=50):
+    for _ in range(warmup):
+        fn()
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - started)
+    return summarize(durations)
+
+
+async def measure_async(fn, repeat=200, warmup=10):
+    for _ in range(warmup):
+        await fn()
+    durations = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await fn()
+        durations.append(time.perf_counter() - started)
+    return summarize(durations)
@@ -0,0 +1,27 @@
+import json
+
+
+# helpers for POST /patients/bulk: turn the request body into a list of raw items,
+# they are then validated in batches (see validation.py).
+
+
+# the body is either NDJSON (one patient per line) or a single JSON array,
+# returns the raw items plus per-item errors for NDJSON lines that are not valid JSON (blank lines are skipped,
+# so an index always counts records, not lines)
+def parse_bulk_body(body, content_type):
+    if 'ndjson' in (content_type or ''):
+        items, errors = [], []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as exc:
+                errors.append({'index': len(items), 'errors': [{'msg': f'Invalid JSON: {exc}'}]})
+                items.append(None)
+        return items, errors
+
+    items = json.loads(body)
+    if not isinstance(items, list):
+        raise ValueError('Expected a JSON array of patients')
+    return items, []
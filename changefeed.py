@@ -0,0 +1,121 @@
+import bisect
+import threading
+from collections import deque
+
+
+# raised by ChangeFeed.since() when the client's position can no longer be served, the client has to read
+# everything again (/view) and continue from the current last_seq
+class ChangesExpired(Exception):
+
+    def __init__(self, since, last_seq):
+        super().__init__(since, last_seq)
+        self.since = since
+        self.last_seq = last_seq
+
+
+# ChangeFeed gives every write a sequence number and keeps the most recent ones in a bounded ring buffer, so a
+# consumer asks for "everything after N" instead of re-reading all patients to find out what changed.
+# an event is the storage entry itself ({'seq', 'op': 'put', 'id', 'record'} or {'seq', 'op': 'patch', 'id', 'changes'}),
+# the sequence number is written to the log together with the entry, which is what lets a position that already
+# fell out of the buffer be served from the storage log instead (see PatientJournal.changes_since), and what lets
+# the numbers continue after a restart.
+#
+# a sharded store shares one feed between all its shards, so the numbers are global and not per shard.
+# only handing out the numbers is serialised, the appends of different shards (or different stripes) still run at the
+# same time and can finish in any order. a finished append waits in _pending until every lower number has finished
+# too, readers only ever see last_seq move past complete, gap-free batches, so they never skip a change that is
+# still being written. a storage log can therefore hold the numbers slightly out of order.
+class ChangeFeed:
+
+    def __init__(self, capacity=10_000):
+        self._events = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        # the last number of which it and everything before it has been appended, what readers see
+        self.last_seq = 0
+        # the last number handed out, appends up to it may still be running
+        self._reserved = 0
+        # first number of a finished batch -> (its last number, its entries), waiting for the batches before it
+        self._pending = {}
+        # every event after this sequence number is in the buffer
+        self._buffer_floor = 0
+        # positions before this one cannot be served at all, not even from the log
+        self.floor = 0
+        # callables run after every publish, the SSE stream in main.py uses them to wake up its clients
+        self._listeners = set()
+
+    # stamp the entries with the next sequence numbers and hand them to `append` (the backend's append), which runs
+    # outside of the feed lock. returns what append returned. numbers of a failed append are skipped, so the sequence
+    # is increasing but not necessarily contiguous
+    def publish(self, entries, append):
+        with self._lock:
+            first = self._reserved + 1
+            self._reserved += len(entries)
+            last = self._reserved
+        for seq, entry in enumerate(entries, first):
+            entry['seq'] = seq
+        try:
+            result = append(entries)
+        except BaseException:
+            self._finish(first, last, [])
+            raise
+        self._finish(first, last, entries)
+        return result
+
+    def _finish(self, first, last, entries):
+        with self._lock:
+            self._pending[first] = (last, entries)
+            advanced = False
+            while self.last_seq + 1 in self._pending:
+                self.last_seq, batch = self._pending.pop(self.last_seq + 1)
+                self._events.extend(batch)
+                advanced = True
+            if len(self._events) == self._events.maxlen:
+                self._buffer_floor = max(self._buffer_floor, self._events[0]['seq'] - 1)
+        if advanced:
+            self._notify()
+
+    # after the data was loaded from storage, which knows the last number it has seen and the oldest position
+    # its log can still serve
+    def restart(self, last_seq, first_seq):
+        with self._lock:
+            # only called while no write is running (the initial load), nothing can be pending
+            self.last_seq = self._reserved = max(self._reserved, last_seq)
+            self.floor = max(self.floor, first_seq)
+            self._events.clear()
+            self._buffer_floor = self.last_seq
+
+    # after the data was replaced or edited from outside, no earlier position leads to the current data any more
+    def expire(self):
+        with self._lock:
+            self.floor = self._buffer_floor = self.last_seq
+            self._events.clear()
+        self._notify()
+
+    # events after `seq` (at most `limit`) and the last sequence number at the time of the call.
+    # positions older than the buffer are passed to fallback(seq), which returns the logged events after it
+    # or None when it cannot, then ChangesExpired is raised
+    def since(self, seq, limit=None, fallback=None):
+        with self._lock:
+            last_seq = self.last_seq
+            if seq < self.floor or seq > last_seq:
+                raise ChangesExpired(seq, last_seq)
+            if seq >= self._buffer_floor:
+                start = bisect.bisect_right(self._events, seq, key=lambda event: event['seq'])
+                stop = len(self._events) if limit is None else min(start + limit, len(self._events))
+                return [self._events[i] for i in range(start, stop)], last_seq
+
+        events = fallback(seq) if fallback is not None else None
+        if events is None:
+            raise ChangesExpired(seq, last_seq)
+        events = [event for event in events if event['seq'] <= last_seq]
+        return events if limit is None else events[:limit], last_seq
+
+    def subscribe(self, listener):
+        self._listeners.add(listener)
+
+    def unsubscribe(self, listener):
+        self._listeners.discard(listener)
+
+    def _notify(self):
+        for listener in list(self._listeners):
+            listener()
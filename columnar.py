@@ -0,0 +1,196 @@
+import threading
+import time
+from array import array
+from collections.abc import MutableMapping
+
+
+# PatientTable is a drop-in replacement for the {id: record} dict inside PatientStore that keeps every field in a
+# column instead of one dict of boxed values per patient:
+#   age, height, weight, bmi  - array('d'), 8 bytes per patient each
+#   city, gender, verdict     - dictionary encoded, array('H') of codes into a list of the distinct values
+#   name                      - one list of str
+# a patient id maps to a row offset, rows of removed patients are reused.
+# a record dict is only built when a patient is read, which keeps the resident size to the columns plus the id map.
+#
+# unlike a dict of dicts the table is changed in place, a write overwrites the row one field at a time while readers
+# (the store reads without the stripe locks) may be building a record from the same row. every row therefore has a
+# version that a write makes odd while it runs and even again when it is done: a reader that saw an odd version, or a
+# different version (or row) after building the record, throws the record away and reads again, so it never returns
+# a mix of two writes. writes themselves are serialised by a lock of the table, they also share the category
+# dictionaries.
+#
+# records go back out exactly as they came in: a per-row bitmask remembers which fields were present and which
+# numbers were ints (85 stays 85, 90.0 stays 90.0), and anything that does not fit a column (a field that is not part
+# of the schema, a value of another type) is kept as-is in a per-row dict of extras.
+
+NUMERIC_FIELDS = ('age', 'height', 'weight', 'bmi')
+CATEGORY_FIELDS = ('city', 'gender', 'verdict')
+TEXT_FIELDS = ('name',)
+
+# the order of the fields in a materialised record, the order Patient.model_dump produces
+FIELD_ORDER = ('name', 'city', 'age', 'gender', 'height', 'weight', 'bmi', 'verdict')
+
+_PRESENT = {field: 1 << i for i, field in enumerate(FIELD_ORDER)}
+_IS_INT = {field: 1 << (len(FIELD_ORDER) + i) for i, field in enumerate(NUMERIC_FIELDS)}
+
+# doubles hold every int up to 2 ** 53 exactly
+_MAX_EXACT_INT = 2 ** 53
+
+
+class PatientTable(MutableMapping):
+
+    def __init__(self, data=()):
+        self._rows = {}
+        self._free = []
+        self._flags = array('H')
+        self._versions = array('Q')
+        self._write_lock = threading.Lock()
+        self._numbers = {field: array('d') for field in NUMERIC_FIELDS}
+        self._codes = {field: array('H') for field in CATEGORY_FIELDS}
+        # field -> (distinct values, {value: code})
+        self._dictionaries = {field: ([], {}) for field in CATEGORY_FIELDS}
+        self._texts = {field: [] for field in TEXT_FIELDS}
+        self._extras = {}
+        self.update(data)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __contains__(self, patient_id):
+        return patient_id in self._rows
+
+    def get(self, patient_id, default=None):
+        record = self._read(patient_id)
+        return default if record is None else record
+
+    def __getitem__(self, patient_id):
+        record = self._read(patient_id)
+        if record is None:
+            raise KeyError(patient_id)
+        return record
+
+    def _read(self, patient_id):
+        while True:
+            row = self._rows.get(patient_id)
+            if row is None:
+                return None
+            version = self._versions[row]
+            if version & 1:
+                # a write of this row is running, let it finish
+                time.sleep(0)
+                continue
+            record = self._record(row)
+            if self._versions[row] == version and self._rows.get(patient_id) == row:
+                return record
+
+    def _record(self, row):
+        flags = self._flags[row]
+        record = {}
+        for field in FIELD_ORDER:
+            if not flags & _PRESENT[field]:
+                continue
+            if field in self._numbers:
+                value = self._numbers[field][row]
+                record[field] = int(value) if flags & _IS_INT[field] else value
+            elif field in self._codes:
+                record[field] = self._dictionaries[field][0][self._codes[field][row]]
+            else:
+                record[field] = self._texts[field][row]
+        extras = self._extras.get(row)
+        if extras:
+            record.update(extras)
+        return record
+
+    def __setitem__(self, patient_id, record):
+        with self._write_lock:
+            row = self._rows.get(patient_id)
+            new = row is None
+            if new:
+                row = self._new_row()
+            self._versions[row] += 1
+            self._write_row(row, record)
+            self._versions[row] += 1
+            # a new row only becomes visible once it is complete
+            if new:
+                self._rows[patient_id] = row
+
+    def _write_row(self, row, record):
+        flags = 0
+        extras = {}
+        for field, value in record.items():
+            if field in self._numbers and _is_number(value):
+                self._numbers[field][row] = value
+                flags |= _PRESENT[field] | (_IS_INT[field] if isinstance(value, int) else 0)
+            elif field in self._codes and isinstance(value, str):
+                self._set_code(field, row, value)
+                flags |= _PRESENT[field]
+            elif field in self._texts and isinstance(value, str):
+                self._texts[field][row] = value
+                flags |= _PRESENT[field]
+            else:
+                extras[field] = value
+        self._flags[row] = flags
+        if extras:
+            self._extras[row] = extras
+        else:
+            self._extras.pop(row, None)
+
+    def _new_row(self):
+        if self._free:
+            return self._free.pop()
+        row = len(self._flags)
+        self._flags.append(0)
+        self._versions.append(0)
+        for column in (*self._numbers.values(), *self._codes.values()):
+            column.append(0)
+        for column in self._texts.values():
+            column.append(None)
+        return row
+
+    def _set_code(self, field, row, value):
+        values, codes = self._dictionaries[field]
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(values)
+            values.append(value)
+            # 'H' holds 65536 distinct values, widen the column the first time a field has more
+            if code > 0xFFFF and self._codes[field].typecode == 'H':
+                self._codes[field] = array('I', self._codes[field])
+        self._codes[field][row] = code
+
+    def __delitem__(self, patient_id):
+        with self._write_lock:
+            row = self._rows.pop(patient_id)
+            self._versions[row] += 1
+            self._flags[row] = 0
+            for column in self._texts.values():
+                column[row] = None
+            self._extras.pop(row, None)
+            self._versions[row] += 1
+            self._free.append(row)
+
+    # a snapshot for compaction, copying the arrays is a memcpy instead of one dict per patient
+    def copy(self):
+        table = PatientTable.__new__(PatientTable)
+        table._rows = dict(self._rows)
+        table._free = list(self._free)
+        table._flags = array(self._flags.typecode, self._flags)
+        table._versions = array('Q', self._versions)
+        table._write_lock = threading.Lock()
+        table._numbers = {field: array(column.typecode, column) for field, column in self._numbers.items()}
+        table._codes = {field: array(column.typecode, column) for field, column in self._codes.items()}
+        table._dictionaries = {field: (list(values), dict(codes)) for field, (values, codes) in self._dictionaries.items()}
+        table._texts = {field: list(column) for field, column in self._texts.items()}
+        table._extras = {row: dict(extras) for row, extras in self._extras.items()}
+        return table
+
+
+def _is_number(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, int):
+        return -_MAX_EXACT_INT <= value <= _MAX_EXACT_INT
+    return isinstance(value, float)
@@ -0,0 +1,37 @@
+import os
+
+from pydantic_core import to_json
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, pydantic-core's encoder is used without it
+    orjson = None
+
+
+# opt-in fast serialisation for patient responses, enabled with PATIENT_FAST_JSON=1.
+# the stored records are already validated plain JSON data, so they skip jsonable_encoder and the stdlib json module:
+# every record is encoded once with orjson (or pydantic-core's to_json), the bytes are kept by the store until the
+# record changes, and list/dict responses are assembled by joining those byte strings.
+ENABLED = os.environ.get('PATIENT_FAST_JSON', '0') == '1'
+
+
+def dumps(content):
+    if orjson is not None:
+        return orjson.dumps(content)
+    return to_json(content)
+
+
+# {"P001": {...}, "P002": {...}} from (patient id, encoded record) pairs
+def join_object(pairs):
+    return b'{' + b','.join(dumps(patient_id) + b':' + body for patient_id, body in pairs) + b'}'
+
+
+def join_array(bodies):
+    return b'[' + b','.join(bodies) + b']'
+
+
+# an encoded record with the patient id added as its first key, '{"id":"P001",...}'
+def with_id(patient_id, body):
+    if body == b'{}':
+        return b'{"id":' + dumps(patient_id) + b'}'
+    return b'{"id":' + dumps(patient_id) + b',' + body[1:]
@@ -0,0 +1,138 @@
+import base64
+import bisect
+import json
+
+
+# a cursor is the (value, patient id) of the last item of a page, encoded so clients treat it as an opaque string
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position, separators=(',', ':')).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        value, patient_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+    if not isinstance(patient_id, str) or not isinstance(value, (int, float, str)):
+        raise ValueError('Invalid cursor')
+    return value, patient_id
+
+
+# SortedIndex keeps (value, patient id) pairs of one field in sorted order, so /sort can slice an already ordered
+# list instead of sorting every patient on every request. the patient id breaks ties and makes every entry unique,
+# which is what lets a cursor point at an exact position. the index is updated incrementally by the store on every write.
+# with field=None the index orders the patients by id, that is what /view pages through.
+class SortedIndex:
+
+    def __init__(self, field, default=0):
+        self.field = field
+        # value used for records that do not have the field, same as the old x.get(sort_by, 0)
+        self.default = default
+        self._entries = []
+
+    def _entry(self, patient_id, record):
+        if self.field is None:
+            return (patient_id, patient_id)
+        return (record.get(self.field, self.default), patient_id)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def build(self, data):
+        self._entries = sorted(self._entry(patient_id, record) for patient_id, record in data.items())
+
+    def add(self, patient_id, record):
+        bisect.insort(self._entries, self._entry(patient_id, record))
+
+    def remove(self, patient_id, record):
+        entry = self._entry(patient_id, record)
+        i = bisect.bisect_left(self._entries, entry)
+        if i < len(self._entries) and self._entries[i] == entry:
+            del self._entries[i]
+
+    # ids of one page in ascending or descending order, either skipping `offset` entries or continuing after the
+    # position encoded in `cursor`. returns the ids and the cursor of the last one (None when nothing is left),
+    # only the returned slice is touched so a top-k query costs O(log n + k)
+    def page(self, offset=0, limit=None, reverse=False, cursor=None):
+        chunk, more = self.page_entries(offset, limit, reverse, cursor)
+        next_cursor = encode_cursor(list(chunk[-1])) if chunk and more else None
+        return [patient_id for _, patient_id in chunk], next_cursor
+
+    # the same page as (value, patient id) entries plus whether more entries follow it,
+    # a sharded store merges these from every shard (see sharding.py)
+    def page_entries(self, offset=0, limit=None, reverse=False, cursor=None):
+        entries = self._entries
+        position = None
+        if cursor is not None:
+            position = decode_cursor(cursor)
+            # a cursor taken from a different field can hold a value that does not compare with ours
+            if entries and isinstance(position[0], str) != isinstance(entries[0][0], str):
+                raise ValueError('Invalid cursor')
+        if reverse:
+            end = len(entries)
+            if position is not None:
+                end = bisect.bisect_left(entries, position)
+            end = max(end - offset, 0)
+            start = 0 if limit is None else max(end - limit, 0)
+            chunk = entries[start:end][::-1]
+            more = start > 0
+        else:
+            start = 0
+            if position is not None:
+                start = bisect.bisect_right(entries, position)
+            start += offset
+            end = len(entries) if limit is None else start + limit
+            chunk = entries[start:end]
+            more = end < len(entries)
+        return chunk, more
+
+    # number of entries with low <= value <= high (either bound may be None), two binary searches, no scan
+    def count_range(self, low=None, high=None):
+        start, end = self._range_bounds(low, high)
+        return max(end - start, 0)
+
+    def range_ids(self, low=None, high=None):
+        start, end = self._range_bounds(low, high)
+        return [patient_id for _, patient_id in self._entries[start:end]]
+
+    def _range_bounds(self, low, high):
+        # ids are strings and every string sorts after '', so ('', ...) / (high, chr(0x10FFFF)) bracket all ids
+        start = 0 if low is None else bisect.bisect_left(self._entries, (low, ''))
+        end = len(self._entries) if high is None else bisect.bisect_right(self._entries, (high, chr(0x10FFFF)))
+        return start, end
+
+
+# normalised form of a value in a HashIndex, strings are matched case-insensitively so 'Obese' and 'obese' are the same verdict
+def hash_key(value):
+    return value.casefold() if isinstance(value, str) else value
+
+
+# HashIndex maps every value of one field to the set of patient ids that have it,
+# an equality filter is then a dict lookup and the size of the set tells the planner how selective it is.
+class HashIndex:
+
+    def __init__(self, field):
+        self.field = field
+        self._buckets = {}
+
+    def build(self, data):
+        self._buckets = {}
+        for patient_id, record in data.items():
+            self.add(patient_id, record)
+
+    def add(self, patient_id, record):
+        self._buckets.setdefault(hash_key(record.get(self.field)), set()).add(patient_id)
+
+    def remove(self, patient_id, record):
+        key = hash_key(record.get(self.field))
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.discard(patient_id)
+            if not bucket:
+                del self._buckets[key]
+
+    def count(self, value):
+        return len(self._buckets.get(hash_key(value), ()))
+
+    def ids(self, value):
+        return list(self._buckets.get(hash_key(value), ()))
@@ -0,0 +1,229 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# per-request timing of the hot paths.
+# code wraps the interesting parts of a request in `with phase('storage_fsync'):` and the time spent there is
+# added to the phases of the current request (if any) and to a process-wide histogram.
+# TimingMiddleware sends the phases of every request back in a Server-Timing header, /metrics exposes the histograms
+# in the Prometheus text format, and with PATIENT_PROFILE_SLOW_MS set slow requests also dump sampled stacks.
+#
+# phases are kept in a dict that lives in a ContextVar, work handed to the store executor runs in a copy of the
+# request's context (see main.run_blocking), so it writes into the same dict.
+
+_request_phases = ContextVar('request_phases', default=None)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # label values -> [bucket counts..., +Inf count, sum]
+        self._series = {}
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        for labels, series in items:
+            label_text = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, labels))
+            prefix = label_text + ',' if label_text else ''
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {series[len(self.buckets)]}')
+            lines.append(f'{self.name}_sum{{{label_text}}} {series[-1]}')
+            lines.append(f'{self.name}_count{{{label_text}}} {series[len(self.buckets)]}')
+        return '\n'.join(lines)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+REQUEST_LATENCY = Histogram('patient_http_request_duration_seconds', 'Time spent handling HTTP requests',
+                            ('method', 'route', 'status'))
+PHASE_LATENCY = Histogram('patient_phase_duration_seconds', 'Time spent in instrumented phases of request handling',
+                          ('phase',))
+
+
+def render_metrics():
+    return REQUEST_LATENCY.render() + '\n' + PHASE_LATENCY.render() + '\n'
+
+
+@contextmanager
+def phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        PHASE_LATENCY.observe(elapsed, name)
+        phases = _request_phases.get()
+        if phases is not None:
+            phases[name] = phases.get(name, 0.0) + elapsed
+
+
+# Server-Timing: storage_fsync;dur=1.204, encode;dur=0.310, app;dur=2.113 (durations in milliseconds)
+def server_timing(phases, total):
+    parts = [f'{name};dur={elapsed * 1000:.3f}' for name, elapsed in phases.items()]
+    parts.append(f'app;dur={total * 1000:.3f}')
+    return ', '.join(parts)
+
+
+# StackSampler records the stacks of all threads every `interval` seconds into a bounded ring buffer.
+# TimingMiddleware asks it for the samples taken while a slow request was running and writes them in the folded
+# format ('frame;frame;frame count' per line) that flamegraph.pl and speedscope read directly.
+# samples cannot be told apart per request, a dump also contains whatever ran concurrently with the slow request.
+#
+# a sample is only (timestamp, stack id): the same few stacks come up over and over, so every distinct stack is
+# folded into a string once and kept in _stacks, instead of one new string per thread and sample in the ring buffer.
+# threads that are parked in an idle wait (see _IDLE_FRAMES) are not sampled at all, an idle executor worker or the
+# event loop waiting in select() says nothing about why a request was slow.
+class StackSampler:
+
+    def __init__(self, interval=0.005, max_samples=200_000):
+        self.interval = interval
+        self._samples = deque(maxlen=max_samples)
+        # ((code, line) of every frame, innermost first) -> stack id, and stack id -> folded stack
+        self._stack_ids = {}
+        self._stacks = []
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            now = time.perf_counter()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_id and not _is_idle(frame):
+                    self._samples.append((now, self._stack_id(frame)))
+            time.sleep(self.interval)
+
+    def _stack_id(self, frame):
+        key = []
+        while frame is not None:
+            key.append((frame.f_code, frame.f_lineno))
+            frame = frame.f_back
+        key = tuple(key)
+        stack_id = self._stack_ids.get(key)
+        if stack_id is None:
+            # only the sampler thread adds stacks, readers index _stacks with ids they took from _samples
+            self._stacks.append(_fold(key))
+            stack_id = self._stack_ids[key] = len(self._stacks) - 1
+        return stack_id
+
+    def folded_between(self, started, finished):
+        counts = {}
+        for timestamp, stack_id in list(self._samples):
+            if started <= timestamp <= finished:
+                counts[stack_id] = counts.get(stack_id, 0) + 1
+        folded = sorted((self._stacks[stack_id], count) for stack_id, count in counts.items())
+        return ''.join(f'{stack} {count}\n' for stack, count in folded)
+
+
+# (file, function) of the innermost frame of a thread that is waiting for work rather than doing any:
+# Condition/Event.wait, queue.Queue.get, an idle ThreadPoolExecutor worker (blocked in the C SimpleQueue.get, so its
+# innermost Python frame is _worker itself) and the event loop waiting for sockets
+_IDLE_FRAMES = {
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('thread.py', '_worker'),
+    ('selectors.py', 'select'),
+}
+
+
+def _is_idle(frame):
+    code = frame.f_code
+    return (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES
+
+
+def _fold(key):
+    names = [f'{code.co_name} ({os.path.basename(code.co_filename)}:{line})' for code, line in key]
+    return ';'.join(reversed(names))
+
+
+# pure ASGI middleware, unlike BaseHTTPMiddleware it does not wrap streaming responses.
+# dumping a profile folds the samples and writes a file, `run_blocking` (main.run_blocking) moves that off the event
+# loop, without it the dump runs on the loop's default executor
+class TimingMiddleware:
+
+    def __init__(self, app, profile_slow_ms=None, profile_dir='profiles', profile_interval_ms=5, run_blocking=None):
+        self.app = app
+        self.run_blocking = run_blocking
+        self.profile_slow = profile_slow_ms / 1000 if profile_slow_ms is not None else None
+        self.profile_dir = profile_dir
+        self.sampler = StackSampler(profile_interval_ms / 1000) if profile_slow_ms is not None else None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        phases = {}
+        token = _request_phases.set(phases)
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_timing(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+                headers = list(message.get('headers', []))
+                headers.append((b'server-timing', server_timing(phases, time.perf_counter() - started).encode()))
+                message = {**message, 'headers': headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            finished = time.perf_counter()
+            _request_phases.reset(token)
+            route = scope.get('route')
+            route_path = route.path if route is not None else 'unmatched'
+            REQUEST_LATENCY.observe(finished - started, scope['method'], route_path, status[0])
+            if self.sampler is not None and finished - started >= self.profile_slow:
+                args = (scope['method'], route_path, started, finished)
+                if self.run_blocking is not None:
+                    await self.run_blocking(self._dump_profile, *args)
+                else:
+                    await asyncio.get_running_loop().run_in_executor(None, self._dump_profile, *args)
+
+    def _dump_profile(self, method, route_path, started, finished):
+        folded = self.sampler.folded_between(started, finished)
+        if not folded:
+            return
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{int((finished - started) * 1000)}ms-{method}{route_path}"
+        name = ''.join(c if c.isalnum() or c in '-_' else '_' for c in name)
+        with open(os.path.join(self.profile_dir, name + '.folded'), 'w') as f:
+            f.write(folded)
+
+
+def middleware_options_from_env(environ=os.environ):
+    slow_ms = environ.get('PATIENT_PROFILE_SLOW_MS')
+    return {
+        'profile_slow_ms': float(slow_ms) if slow_ms else None,
+        'profile_dir': environ.get('PATIENT_PROFILE_DIR', 'profiles'),
+        'profile_interval_ms': float(environ.get('PATIENT_PROFILE_INTERVAL_MS', '5')),
+    }
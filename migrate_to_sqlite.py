@@ -0,0 +1,28 @@
+import argparse
+
+from storage import PatientJournal, SqliteBackend
+
+
+# one-off migration from the JSON storage to SQLite:
+#     python migrate_to_sqlite.py patients.json patients.db
+# the JSON side is read through PatientJournal, so writes still sitting in patients.json.log are migrated as well.
+# afterwards start the app with PATIENT_STORAGE=sqlite PATIENT_DATA_PATH=patients.db
+def migrate(json_path, db_path):
+    journal = PatientJournal(json_path)
+    data = journal.load()
+    journal.close()
+
+    backend = SqliteBackend(db_path)
+    backend.write_snapshot(data)
+    backend.close()
+    return len(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import patients.json into a SQLite database')
+    parser.add_argument('json_path', nargs='?', default='patients.json')
+    parser.add_argument('db_path', nargs='?', default='patients.db')
+    args = parser.parse_args()
+
+    count = migrate(args.json_path, args.db_path)
+    print(f'migrated {count} patients from {args.json_path} to {args.db_path}')
@@ -0,0 +1,69 @@
+from functools import lru_cache
+
+
+# numpy is imported the first time a batch function needs it, importing it takes longer than the rest of the
+# app's own modules together and most processes (short-lived workers, single edits) never use it.
+# numpy is optional, without it the batch functions fall back to plain python
+@lru_cache(maxsize=None)
+def numpy_or_none():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+# bmi and verdict are derived from height (cm) and weight (kg). the same formulas are used by Patient's computed
+# fields, by the edit endpoint when height or weight change, and in vectorised form for whole batches of patients.
+
+def bmi_for(height, weight):
+    return round(weight / ((height / 100) ** 2), 2)
+
+
+def verdict_for(bmi):
+    if bmi < 18.5:
+        return 'underweight'
+    elif 18.5 <= bmi < 24.9:
+        return 'normal'
+    elif 25 <= bmi < 29.9:
+        return 'overweight'
+    else:
+        return 'obese'
+
+
+def derived_fields(height, weight):
+    bmi = bmi_for(height, weight)
+    return {'bmi': bmi, 'verdict': verdict_for(bmi)}
+
+
+# bmi for a whole batch at once, returns a list of floats identical to [bmi_for(h, w) ...].
+# np.round multiplies by 100 before rounding, which can round the other way than round() for values that sit
+# right on a .xx5 boundary, those few are rounded again one by one so stored values never depend on the code path
+def bmi_batch(heights, weights):
+    np = numpy_or_none()
+    if np is None:
+        return [bmi_for(height, weight) for height, weight in zip(heights, weights)]
+
+    raw = np.asarray(weights, dtype=np.float64) / (np.asarray(heights, dtype=np.float64) / 100) ** 2
+    bmi = np.round(raw, 2)
+    scaled = raw * 100
+    ties = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)
+    if len(ties):
+        bmi[ties] = [round(value, 2) for value in raw[ties].tolist()]
+    return bmi.tolist()
+
+
+def verdict_batch(bmis):
+    np = numpy_or_none()
+    if np is None:
+        return [verdict_for(bmi) for bmi in bmis]
+
+    bmi = np.asarray(bmis, dtype=np.float64)
+    conditions = [bmi < 18.5, (bmi >= 18.5) & (bmi < 24.9), (bmi >= 25) & (bmi < 29.9)]
+    return np.select(conditions, ['underweight', 'normal', 'overweight'], 'obese').tolist()
+
+
+# (bmis, verdicts) for parallel sequences of heights and weights
+def derived_fields_batch(heights, weights):
+    bmis = bmi_batch(heights, weights)
+    return bmis, verdict_batch(bmis)
@@ -0,0 +1,397 @@
+import hashlib
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import fast_json
+from changefeed import ChangeFeed
+from columnar import PatientTable
+from indexes import HashIndex, SortedIndex, hash_key
+from instrumentation import phase
+from stats import PatientStats
+from storage import PatientJournal, apply_entry
+
+
+# raised by patch() when the record was changed by someone else after the caller read it
+class VersionConflict(Exception):
+    pass
+
+
+# strong ETag of a stored record, derived from its content so it stays valid across restarts
+def etag_for(record):
+    payload = json.dumps(record, sort_keys=True, separators=(',', ':')).encode()
+    return '"%s"' % hashlib.sha1(payload).hexdigest()[:20]
+
+
+# PatientStore keeps the whole patient set in memory for the lifetime of the process.
+# earlier every endpoint called load_data(), which re-opened and re-parsed patients.json on every request,
+# now the state is rebuilt once at startup, reads are served from the in-memory dict,
+# and every mutation is written to the storage backend (see storage.py) before the endpoint returns,
+# by default that is the patients.json journal, a SQLite backend can be passed in instead.
+#
+# concurrency: mutations lock only the stripe their patient id hashes to, so writes to different patients run in
+# parallel while a check-then-insert on the same id can never interleave. every record also carries a version
+# number which is bumped on each write, patch() takes the version the caller read and refuses to overwrite a newer one.
+# operations that touch the whole data set (reload, compaction, replace_all) take all stripes.
+#
+# secondary indexes (see indexes.py) are shared by all stripes, so they have their own short lock
+# which is held only while an entry is moved inside an index or a page is sliced out of it.
+class PatientStore:
+
+    def __init__(self, path='patients.json', check_interval=1.0, compact_min_entries=1000, lock_stripes=64,
+                 sorted_fields=('height', 'weight', 'bmi', 'age'), hash_fields=('city', 'gender', 'verdict'), backend=None,
+                 compact=False, lazy=False, changes=None):
+        # how often (in seconds) reads ask the backend whether the data was edited from outside of this process
+        self.check_interval = check_interval
+        if backend is None:
+            backend = PatientJournal(path, compact_min_entries=compact_min_entries)
+        self.backend = backend
+        # compact=True keeps the records in a columnar PatientTable (see columnar.py) instead of a dict of dicts
+        self.compact = compact
+        self._stripes = [threading.Lock() for _ in range(lock_stripes)]
+        self._data = {}
+        self._versions = {}
+        # JSON bytes of records that were served through the fast serialisation path, see encoded()
+        self._encoded = {}
+        self.sorted_indexes = {field: SortedIndex(field) for field in sorted_fields}
+        self.hash_indexes = {field: HashIndex(field) for field in hash_fields}
+        # patients ordered by id, used to page and stream through everything without copying the whole dict
+        self.id_index = SortedIndex(None)
+        # running counts, moments and quantile sketches for /patients/stats, kept up to date with the indexes
+        self._stats = PatientStats()
+        # sequence numbers and recent writes for /patients/changes, see changefeed.py (shared by the shards of a sharded store)
+        self.changes = changes if changes is not None else ChangeFeed()
+        self._index_lock = threading.Lock()
+        # global data version, bumped on every mutation, the per-patient versions are taken from the same counter
+        # so they keep increasing across reloads. the lock only guards this one increment
+        self._version_lock = threading.Lock()
+        self.version = 0
+        self._last_check = 0.0
+        # with lazy=True nothing is read until the owner calls load(), main.py does that in the background on startup
+        self.loaded = False
+        if not lazy:
+            self.load()
+
+    def _stripe(self, patient_id):
+        return self._stripes[hash(patient_id) % len(self._stripes)]
+
+    # stripes for a set of ids, always acquired in the same order so two bulk writers cannot deadlock
+    @contextmanager
+    def _stripes_for(self, patient_ids):
+        locks = [self._stripes[i] for i in sorted({hash(patient_id) % len(self._stripes) for patient_id in patient_ids})]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    @contextmanager
+    def _all_stripes(self):
+        for lock in self._stripes:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(self._stripes):
+                lock.release()
+
+    def _table(self, data):
+        return PatientTable(data) if self.compact else dict(data)
+
+    def _bump_version(self):
+        with self._version_lock:
+            self.version += 1
+            return self.version
+
+    def load(self):
+        with self._all_stripes():
+            self._load()
+
+    def _load(self):
+        with phase('storage_load'):
+            data = self._table(self.backend.load())
+        self._replace_data(data)
+        # bumped after the indexes are rebuilt, for the same reason as in _write
+        self._versions = dict.fromkeys(self._data, self._bump_version())
+        if self.loaded:
+            # reloaded after an edit from outside, the feed cannot say what that edit changed
+            self.changes.expire()
+        else:
+            self.changes.restart(self.backend.last_seq, self.backend.first_seq)
+        self._last_check = time.monotonic()
+        self.loaded = True
+
+    # the new indexes and stats are built next to the current ones, then the data and all of them are swapped in
+    # together under the index lock, so a reader can never look up ids of the old index in the new data.
+    # must be called with all stripes held
+    def _replace_data(self, data):
+        id_index = SortedIndex(None)
+        id_index.build(data)
+        sorted_indexes = {field: SortedIndex(field) for field in self.sorted_indexes}
+        hash_indexes = {field: HashIndex(field) for field in self.hash_indexes}
+        for index in (*sorted_indexes.values(), *hash_indexes.values()):
+            index.build(data)
+        stats = PatientStats()
+        stats.build(data)
+        with self._index_lock:
+            self._data = data
+            self.id_index, self.sorted_indexes, self.hash_indexes, self._stats = id_index, sorted_indexes, hash_indexes, stats
+            self._encoded = {}
+
+    def _reindex(self, patient_id, old_record, new_record):
+        with self._index_lock:
+            if old_record is None:
+                self.id_index.add(patient_id, new_record)
+            for index in (*self.sorted_indexes.values(), *self.hash_indexes.values()):
+                if old_record is not None:
+                    index.remove(patient_id, old_record)
+                index.add(patient_id, new_record)
+            if old_record is not None:
+                self._stats.remove(old_record)
+            self._stats.add(new_record)
+
+    # reload if the data was changed by somebody else, the check is rate limited by check_interval.
+    # with check_interval=None reads never check inline and the owner calls reload_if_changed() from a background task
+    def refresh(self):
+        if self.check_interval is None:
+            return
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        self.reload_if_changed()
+
+    def reload_if_changed(self):
+        if self.backend.snapshot_changed():
+            with self._all_stripes():
+                if self.backend.snapshot_changed():
+                    self._load()
+
+    # append the entries to the backend and apply them in memory, must be called with the stripe locks of all
+    # touched ids held, returns the ticket the caller waits on (after releasing the locks) until the entries are on disk
+    def _write(self, entries):
+        with phase('storage_append'):
+            ticket = self.changes.publish(entries, self.backend.append)
+        for entry in entries:
+            patient_id = entry['id']
+            old_record = self._data.get(patient_id)
+            apply_entry(self._data, entry)
+            self._encoded.pop(patient_id, None)
+            self._reindex(patient_id, old_record, self._data[patient_id])
+        # the versions move only once the data, indexes and stats are updated: a reader that raced with the write can
+        # then only have cached the new data under the old version, which the next read with the new version misses.
+        # bumping first would let it cache the old data under the new version, served until some other write
+        version = self._bump_version()
+        for entry in entries:
+            self._versions[entry['id']] = version
+        return ticket
+
+    # wait until our entries are durable, then start a compaction if the log has grown large enough,
+    # holding every stripe guarantees that each entry in the parked log has also been applied to the copy
+    def _commit(self, ticket):
+        with phase('storage_fsync'):
+            self.backend.sync(ticket)
+        if self.backend.needs_compaction(len(self._data)):
+            with self._all_stripes():
+                if self.backend.needs_compaction(len(self._data)):
+                    # records are never mutated in place, so a shallow copy is a consistent snapshot
+                    self.backend.start_compaction(self._data.copy())
+
+    def __contains__(self, patient_id):
+        self.refresh()
+        return patient_id in self._data
+
+    def __len__(self):
+        self.refresh()
+        return len(self._data)
+
+    def get(self, patient_id):
+        self.refresh()
+        return self._data.get(patient_id)
+
+    # the record together with the version to hand back to patch(), (None, 0) for an unknown id
+    def get_with_version(self, patient_id):
+        self.refresh()
+        with self._stripe(patient_id):
+            return self._data.get(patient_id), self._versions.get(patient_id, 0)
+
+    # version of one patient, it changes whenever that patient is written (0 for an unknown id)
+    def patient_version(self, patient_id):
+        return self._versions.get(patient_id, 0)
+
+    # shallow copy, so a concurrent create cannot change the dict while a response is being encoded
+    def all(self):
+        self.refresh()
+        return dict(self._data)
+
+    def values(self):
+        return list(self.all().values())
+
+    # one page of patients ordered by a sorted index field, see SortedIndex.page for offset/limit/cursor,
+    # raises ValueError for a bad cursor. returns the records and the cursor for the next page
+    def sorted_page(self, field, reverse=False, offset=0, limit=None, cursor=None):
+        self.refresh()
+        with phase('index'), self._index_lock:
+            patient_ids, next_cursor = self.sorted_indexes[field].page(offset, limit, reverse, cursor)
+            records = [self._data[patient_id] for patient_id in patient_ids]
+        return records, next_cursor
+
+    # same as sorted_page, but only the ids
+    def sorted_ids(self, field, reverse=False, offset=0, limit=None, cursor=None):
+        self.refresh()
+        with phase('index'), self._index_lock:
+            return self.sorted_indexes[field].page(offset, limit, reverse, cursor)
+
+    # the writes after sequence number `since` (at most `limit`) and the current last sequence number,
+    # raises ChangesExpired when they are neither in the feed's buffer nor in the storage log any more
+    def changes_since(self, since, limit=None):
+        return self.changes.since(since, limit, fallback=self.backend.changes_since)
+
+    # a copy of the running aggregates, see stats.py. its size depends on the number of distinct cities and
+    # sketch buckets, not on the number of patients
+    def stats(self):
+        self.refresh()
+        with self._index_lock:
+            return self._stats.copy()
+
+    # same as sorted_ids, but (value, id) entries and whether more entries follow instead of a cursor
+    def sorted_entries(self, field, reverse=False, offset=0, limit=None, cursor=None):
+        self.refresh()
+        with phase('index'), self._index_lock:
+            return self.sorted_indexes[field].page_entries(offset, limit, reverse, cursor)
+
+    # the record encoded as JSON bytes, encoded once and then reused until the record is written again (None for an
+    # unknown id). it runs under the patient's stripe lock, which is also held while a write replaces the record and
+    # drops its bytes, so the bytes can never belong to an older version of the record
+    def encoded(self, patient_id):
+        with self._stripe(patient_id):
+            body = self._encoded.get(patient_id)
+            if body is None:
+                record = self._data.get(patient_id)
+                if record is None:
+                    return None
+                body = self._encoded[patient_id] = fast_json.dumps(record)
+            return body
+
+    # one page of {id: record} in id order, continuing after `cursor`, returns the page and the next cursor
+    def id_page(self, limit=None, cursor=None):
+        self.refresh()
+        with phase('index'), self._index_lock:
+            patient_ids, next_cursor = self.id_index.page(limit=limit, cursor=cursor)
+            page = {patient_id: self._data[patient_id] for patient_id in patient_ids}
+        return page, next_cursor
+
+    # patients matching all filters: `equals` maps hash-indexed fields to a value, `ranges` maps sorted-indexed fields
+    # to an inclusive (low, high) pair where either bound may be None.
+    # the planner asks every usable index how many patients it would return (a dict lookup or two binary searches),
+    # walks only the smallest candidate set and checks the remaining filters on those records, so the cost follows the
+    # size of the most selective filter rather than the number of patients. without any filter every patient matches.
+    # returns [(id, record)] ordered by id
+    def search(self, equals=None, ranges=None):
+        self.refresh()
+        equals = equals or {}
+        ranges = ranges or {}
+        with phase('index'), self._index_lock:
+            plans = [(self.hash_indexes[field].count(value), self.hash_indexes[field].ids, (value,))
+                     for field, value in equals.items()]
+            plans += [(self.sorted_indexes[field].count_range(low, high), self.sorted_indexes[field].range_ids, (low, high))
+                      for field, (low, high) in ranges.items()]
+            if plans:
+                _, lookup, args = min(plans, key=lambda plan: plan[0])
+                candidates = lookup(*args)
+            else:
+                candidates = list(self._data)
+
+        wanted = {field: hash_key(value) for field, value in equals.items()}
+        results = []
+        for patient_id in candidates:
+            record = self._data.get(patient_id)
+            if record is not None and self._matches(record, wanted, ranges):
+                results.append((patient_id, record))
+        results.sort(key=lambda item: item[0])
+        return results
+
+    @staticmethod
+    def _matches(record, wanted, ranges):
+        for field, value in wanted.items():
+            if hash_key(record.get(field)) != value:
+                return False
+        for field, (low, high) in ranges.items():
+            value = record.get(field, 0)
+            if (low is not None and value < low) or (high is not None and value > high):
+                return False
+        return True
+
+    # returns False instead of overwriting when the id is already taken
+    def create(self, patient_id, record):
+        self.refresh()
+        with self._stripe(patient_id):
+            if patient_id in self._data:
+                return False
+            ticket = self._write([{'op': 'put', 'id': patient_id, 'record': record}])
+        self._commit(ticket)
+        return True
+
+    # create many patients with a single backend append (one journal fsync or one SQLite transaction),
+    # ids that already exist are skipped and returned so the caller can report them
+    def create_many(self, records):
+        self.refresh()
+        with self._stripes_for(records):
+            existing = [patient_id for patient_id in records if patient_id in self._data]
+            entries = [{'op': 'put', 'id': patient_id, 'record': record}
+                       for patient_id, record in records.items() if patient_id not in self._data]
+            ticket = self._write(entries) if entries else None
+        if ticket is not None:
+            self._commit(ticket)
+        return existing
+
+    # apply a partial update, only `changes` is written to the backend instead of the whole record.
+    # derive(record, changes) can return more changes computed from the current record (the main app recomputes
+    # bmi and verdict with it), it runs under the stripe lock so it always sees the record the changes are applied to.
+    # returns the new record, or None for an unknown id, raises VersionConflict when expected_version is given
+    # and the record has been written since that version was read
+    def patch(self, patient_id, changes, derive=None, expected_version=None):
+        self.refresh()
+        with self._stripe(patient_id):
+            record = self._data.get(patient_id)
+            if record is None:
+                return None
+            if expected_version is not None and self._versions.get(patient_id) != expected_version:
+                raise VersionConflict(patient_id)
+            ticket = self._write([self._patch_entry(patient_id, record, changes, derive)])
+            record = self._data[patient_id]
+        self._commit(ticket)
+        return record
+
+    # many partial updates with a single backend append (one journal fsync or one SQLite transaction),
+    # {id: changes} -> the ids that do not exist, nothing is written for those
+    def patch_many(self, changes_by_id, derive=None):
+        self.refresh()
+        with self._stripes_for(changes_by_id):
+            missing = [patient_id for patient_id in changes_by_id if patient_id not in self._data]
+            entries = [self._patch_entry(patient_id, self._data[patient_id], changes, derive)
+                       for patient_id, changes in changes_by_id.items() if patient_id in self._data]
+            ticket = self._write(entries) if entries else None
+        if ticket is not None:
+            self._commit(ticket)
+        return missing
+
+    @staticmethod
+    def _patch_entry(patient_id, record, changes, derive):
+        if derive is not None:
+            changes = {**changes, **derive(record, changes)}
+        return {'op': 'patch', 'id': patient_id, 'changes': changes}
+
+    def replace_all(self, data):
+        with self._all_stripes():
+            self._replace_data(self._table(data))
+            self._versions = dict.fromkeys(self._data, self._bump_version())
+            with phase('storage_snapshot'):
+                self.backend.write_snapshot(self._data)
+            self.changes.expire()
+
+    def close(self):
+        self.backend.close()
@@ -0,0 +1,75 @@
+import hashlib
+from collections import OrderedDict
+
+
+# If-None-Match may hold '*' or a list of (possibly weak) ETags, for a GET they are compared weakly
+def etag_matches(header, etag):
+    if header is None:
+        return False
+    if header.strip() == '*':
+        return True
+    bare = etag.removeprefix('W/')
+    return any(tag.strip().removeprefix('W/') == bare for tag in header.split(','))
+
+
+def etag_for_body(body):
+    return '"%s"' % hashlib.sha1(body).hexdigest()[:20]
+
+
+class CachedResponse:
+
+    __slots__ = ('version', 'body', 'etag', 'headers')
+
+    def __init__(self, version, body, etag, headers):
+        self.version = version
+        self.body = body
+        self.etag = etag
+        self.headers = headers
+
+
+# ResponseCache keeps encoded response bodies of the read endpoints, keyed by route and query parameters.
+# every entry remembers the data version it was built from, the store bumps its global version on every write and
+# the version of a single patient when that patient is written, so a lookup with a newer version is a miss and the
+# stale entry is dropped, nothing is served after the data it was built from changed.
+# least recently used entries are evicted once the bodies add up to more than max_bytes.
+# the cache is only touched from the event loop, so it needs no lock.
+class ResponseCache:
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, version):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.version != version:
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    # store an encoded body, the ETag defaults to a hash of the body. bodies larger than the whole budget are not
+    # kept, the returned entry is still usable for the current response
+    def put(self, key, version, body, headers=None, etag=None):
+        entry = CachedResponse(version, body, etag or etag_for_body(body), headers or {})
+        if len(body) > self.max_bytes:
+            return entry
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = entry
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+        return entry
+
+    def _drop(self, key):
+        self.size -= len(self._entries.pop(key).body)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
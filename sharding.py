@@ -0,0 +1,198 @@
+import heapq
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from changefeed import ChangeFeed
+from indexes import encode_cursor
+from patient_store import PatientStore
+from stats import PatientStats
+from storage import backend_from_env, data_path_from_env
+
+
+# the shard that owns a patient. crc32 rather than hash(), which is randomised per process,
+# so a patient maps to the same shard (and the same files) after every restart
+def shard_for(patient_id, shard_count):
+    return zlib.crc32(patient_id.encode()) % shard_count
+
+
+# ShardedPatientStore hash-partitions the patients over several PatientStores, each with its own journal or
+# SQLite file, its own locks, versions and indexes. it offers the same methods as PatientStore, so main.py does not
+# care which one it talks to.
+# single-patient calls (get, create, patch, ...) are routed to the owning shard, which is what lets writes scale:
+# writes to different shards append to different logs and wait for different fsyncs instead of queueing on one file.
+# calls over all patients scatter to every shard and gather the results, the per-shard results are already ordered
+# (by id, or by (value, id) for /sort) so they are combined with a k-way merge instead of being sorted again.
+class ShardedPatientStore:
+
+    def __init__(self, shards):
+        self.shards = shards
+        # used to write the per-shard parts of a bulk import at the same time
+        self._executor = ThreadPoolExecutor(max_workers=len(shards), thread_name_prefix='patient-shard')
+
+    def shard(self, patient_id):
+        return self.shards[shard_for(patient_id, len(self.shards))]
+
+    # the one feed all shards publish to, see store_from_env
+    @property
+    def changes(self):
+        return self.shards[0].changes
+
+    # the shard versions only ever grow, so their sum changes whenever any shard is written or reloaded
+    @property
+    def version(self):
+        return sum(shard.version for shard in self.shards)
+
+    def _split(self, records):
+        parts = [{} for _ in self.shards]
+        for patient_id, record in records.items():
+            parts[shard_for(patient_id, len(self.shards))][patient_id] = record
+        return parts
+
+    @property
+    def loaded(self):
+        return all(shard.loaded for shard in self.shards)
+
+    # the shards are read at the same time, parsing their files is most of the work of a restart
+    def load(self):
+        list(self._executor.map(lambda shard: shard.load(), self.shards))
+
+    def refresh(self):
+        for shard in self.shards:
+            shard.refresh()
+
+    def reload_if_changed(self):
+        for shard in self.shards:
+            shard.reload_if_changed()
+
+    # ---- routed to the owning shard ----
+
+    def __contains__(self, patient_id):
+        return patient_id in self.shard(patient_id)
+
+    def get(self, patient_id):
+        return self.shard(patient_id).get(patient_id)
+
+    def get_with_version(self, patient_id):
+        return self.shard(patient_id).get_with_version(patient_id)
+
+    def patient_version(self, patient_id):
+        return self.shard(patient_id).patient_version(patient_id)
+
+    def encoded(self, patient_id):
+        return self.shard(patient_id).encoded(patient_id)
+
+    def create(self, patient_id, record):
+        return self.shard(patient_id).create(patient_id, record)
+
+    def patch(self, patient_id, changes, derive=None, expected_version=None):
+        return self.shard(patient_id).patch(patient_id, changes, derive=derive, expected_version=expected_version)
+
+    # ---- scattered to every shard ----
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    # every shard writes its part with its own single append, the parts are written concurrently
+    def create_many(self, records):
+        parts = self._split(records)
+        results = self._executor.map(lambda item: item[0].create_many(item[1]) if item[1] else [], zip(self.shards, parts))
+        return [patient_id for existing in results for patient_id in existing]
+
+    def patch_many(self, changes_by_id, derive=None):
+        parts = self._split(changes_by_id)
+        results = self._executor.map(lambda item: item[0].patch_many(item[1], derive) if item[1] else [], zip(self.shards, parts))
+        return [patient_id for missing in results for patient_id in missing]
+
+    def replace_all(self, data):
+        for shard, part in zip(self.shards, self._split(data)):
+            shard.replace_all(part)
+
+    # {id: record} of every patient in id order
+    def all(self):
+        return dict(heapq.merge(*(shard.id_page()[0].items() for shard in self.shards), key=lambda item: item[0]))
+
+    def values(self):
+        return self.all().values()
+
+    # the shards page through their own id index after the same cursor, the first `limit` ids of the merged
+    # pages are the global page (a cursor is just the last id, so it means the same thing on every shard)
+    def id_page(self, limit=None, cursor=None):
+        pages = [shard.id_page(limit=limit, cursor=cursor) for shard in self.shards]
+        merged = heapq.merge(*(page.items() for page, _ in pages), key=lambda item: item[0])
+        page = dict(merged if limit is None else (item for _, item in zip(range(limit), merged)))
+        more = any(next_cursor is not None for _, next_cursor in pages) or sum(len(page) for page, _ in pages) > len(page)
+        if not page or not more:
+            return page, None
+        last_id = next(reversed(page))
+        return page, encode_cursor([last_id, last_id])
+
+    # k-way merge of the shards' sorted pages. the global page starts at the same cursor but may take any number of
+    # its `offset` entries from any one shard, so every shard returns its first offset + limit entries
+    def sorted_ids(self, field, reverse=False, offset=0, limit=None, cursor=None):
+        wanted = None if limit is None else offset + limit
+        pages = [shard.sorted_entries(field, reverse=reverse, limit=wanted, cursor=cursor) for shard in self.shards]
+        merged = list(heapq.merge(*(entries for entries, _ in pages), reverse=reverse))
+        chunk = merged[offset:] if limit is None else merged[offset:offset + limit]
+        more = any(more for _, more in pages) or len(merged) > offset + len(chunk)
+        next_cursor = encode_cursor(list(chunk[-1])) if chunk and more else None
+        return [patient_id for _, patient_id in chunk], next_cursor
+
+    def sorted_page(self, field, reverse=False, offset=0, limit=None, cursor=None):
+        patient_ids, next_cursor = self.sorted_ids(field, reverse=reverse, offset=offset, limit=limit, cursor=cursor)
+        return [self.get(patient_id) for patient_id in patient_ids], next_cursor
+
+    # a position older than the shared buffer is looked up in the log of every shard, the per-shard results are
+    # each in sequence order and are merged into one. if any shard's log no longer reaches back that far it expires
+    def changes_since(self, since, limit=None):
+        return self.changes.since(since, limit, fallback=self._logged_changes)
+
+    def _logged_changes(self, since):
+        parts = [shard.backend.changes_since(since) for shard in self.shards]
+        if any(part is None for part in parts):
+            return None
+        return list(heapq.merge(*parts, key=lambda entry: entry['seq']))
+
+    # the running aggregates of all shards merged into one
+    def stats(self):
+        stats = PatientStats()
+        for shard in self.shards:
+            stats.merge(shard.stats())
+        return stats
+
+    # every shard plans and runs the search on its own indexes, the id-ordered results are merged
+    def search(self, equals=None, ranges=None):
+        return list(heapq.merge(*(shard.search(equals, ranges) for shard in self.shards), key=lambda item: item[0]))
+
+    def close(self):
+        self._executor.shutdown()
+        for shard in self.shards:
+            shard.close()
+
+
+# PATIENT_SHARDS=N (default 1) splits the data over N shards, each stored in its own file next to the unsharded
+# data (patients.shard0.json, patients.shard1.json, ...). the first sharded start copies the unsharded data into the
+# shards, after that the shard files are the data and the unsharded file is left alone.
+def store_from_env(environ=os.environ, **options):
+    # PATIENT_COMPACT=1 keeps the records in columnar tables, see columnar.py
+    options.setdefault('compact', environ.get('PATIENT_COMPACT', '0') == '1')
+    # PATIENT_CHANGES_BUFFER is the number of recent writes the change feed keeps in memory, one feed for all shards
+    options.setdefault('changes', ChangeFeed(int(environ.get('PATIENT_CHANGES_BUFFER', '10000'))))
+    shard_count = int(environ.get('PATIENT_SHARDS', '1'))
+    if shard_count <= 1:
+        return PatientStore(backend=backend_from_env(environ), **options)
+
+    seed = not any(_data_exists(data_path_from_env(environ, shard)) for shard in range(shard_count))
+    store = ShardedPatientStore([PatientStore(backend=backend_from_env(environ, shard), **options)
+                                 for shard in range(shard_count)])
+    if seed and _data_exists(data_path_from_env(environ)):
+        if not store.loaded:
+            store.load()
+        backend = backend_from_env(environ)
+        store.replace_all(backend.load())
+        backend.close()
+    return store
+
+
+def _data_exists(path):
+    return os.path.exists(path) or os.path.exists(path + '.log')
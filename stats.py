@@ -0,0 +1,291 @@
+import math
+
+from patient_metrics import numpy_or_none
+
+
+# running aggregates behind GET /patients/stats. the store updates them on every write together with its indexes
+# (a write removes the old record and adds the new one), so a summary never has to look at the patients themselves:
+# counts per verdict and city, Welford mean/variance and a quantile sketch per numeric field, overall and per gender.
+# all of it can be merged, which is how a sharded store combines the summaries of its shards.
+
+STAT_FIELDS = ('bmi', 'age', 'height', 'weight')
+COUNT_FIELDS = ('verdict', 'city')
+
+
+def _number(value):
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+# Welford's running mean and variance. remove() runs the update backwards, so a record that changes is taken out
+# with its old values and put back with the new ones
+class RunningMoments:
+
+    __slots__ = ('count', 'mean', 'm2')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def remove(self, value):
+        if self.count <= 1:
+            self.count, self.mean, self.m2 = 0, 0.0, 0.0
+            return
+        delta = value - self.mean
+        self.mean = (self.count * self.mean - value) / (self.count - 1)
+        self.count -= 1
+        # rounding can leave a tiny negative sum of squares after many removals
+        self.m2 = max(self.m2 - delta * (value - self.mean), 0.0)
+
+    # Chan et al.'s parallel combination of two sets of moments
+    def merge(self, other):
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+
+    def copy(self):
+        moments = RunningMoments()
+        moments.count, moments.mean, moments.m2 = self.count, self.mean, self.m2
+        return moments
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / self.count) if self.count else None
+
+
+# QuantileSketch is a DDSketch style log-bucketed histogram: a positive value lands in bucket ceil(log_gamma(value)),
+# so every bucket spans values within `relative_accuracy` of its midpoint and a quantile read from it is off by at most
+# that fraction (1% by default). unlike sampling sketches a value can be removed again by decrementing its bucket,
+# and two sketches merge by adding their bucket counts. the number of buckets depends on the spread of the values
+# (a few hundred for bmi, age, height or weight), not on the number of patients.
+class QuantileSketch:
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        # values <= 0 cannot be log-bucketed, they are all counted as 0
+        self.zero_count = 0
+        self.count = 0
+
+    def _key(self, value):
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def add(self, value):
+        self.count += 1
+        if value <= 0:
+            self.zero_count += 1
+            return
+        key = self._key(value)
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def remove(self, value):
+        if value <= 0:
+            if self.zero_count:
+                self.zero_count -= 1
+                self.count -= 1
+            return
+        key = self._key(value)
+        remaining = self.buckets.get(key, 0) - 1
+        if remaining < 0:
+            return
+        if remaining:
+            self.buckets[key] = remaining
+        else:
+            del self.buckets[key]
+        self.count -= 1
+
+    def merge(self, other):
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+
+    def copy(self):
+        sketch = QuantileSketch(self.relative_accuracy)
+        sketch.buckets = dict(self.buckets)
+        sketch.zero_count = self.zero_count
+        sketch.count = self.count
+        return sketch
+
+    # q between 0 and 1, None while the sketch is empty
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+# the aggregates of one group of patients (everybody, or everybody of one gender)
+class SummaryGroup:
+
+    def __init__(self):
+        self.count = 0
+        self.counts = {field: {} for field in COUNT_FIELDS}
+        self.moments = {field: RunningMoments() for field in STAT_FIELDS}
+        self.sketches = {field: QuantileSketch() for field in STAT_FIELDS}
+
+    def add(self, record):
+        self.count += 1
+        for field, counts in self.counts.items():
+            value = record.get(field)
+            counts[value] = counts.get(value, 0) + 1
+        for field in STAT_FIELDS:
+            value = _number(record.get(field))
+            if value is not None:
+                self.moments[field].add(value)
+                self.sketches[field].add(value)
+
+    def remove(self, record):
+        self.count -= 1
+        for field, counts in self.counts.items():
+            value = record.get(field)
+            remaining = counts.get(value, 0) - 1
+            if remaining > 0:
+                counts[value] = remaining
+            else:
+                counts.pop(value, None)
+        for field in STAT_FIELDS:
+            value = _number(record.get(field))
+            if value is not None:
+                self.moments[field].remove(value)
+                self.sketches[field].remove(value)
+
+    def merge(self, other):
+        self.count += other.count
+        for field, counts in other.counts.items():
+            for value, count in counts.items():
+                self.counts[field][value] = self.counts[field].get(value, 0) + count
+        for field in STAT_FIELDS:
+            self.moments[field].merge(other.moments[field])
+            self.sketches[field].merge(other.sketches[field])
+
+    def copy(self):
+        group = SummaryGroup()
+        group.merge(self)
+        return group
+
+    def summary(self, percentiles):
+        fields = {}
+        for field in STAT_FIELDS:
+            moments, sketch = self.moments[field], self.sketches[field]
+            fields[field] = {'count': moments.count, 'mean': moments.mean if moments.count else None, 'std': moments.std,
+                             **{f'p{p:g}': sketch.quantile(p / 100) for p in percentiles}}
+        return _group_summary(self.count, self.counts, fields)
+
+
+def _group_summary(count, counts, fields):
+    return {'count': count, **{field: _sorted_counts(counts[field]) for field in COUNT_FIELDS}, 'fields': fields}
+
+
+def _sorted_counts(counts):
+    return dict(sorted(counts.items(), key=lambda item: (-item[1], str(item[0]))))
+
+
+# PatientStats holds the summary of all patients plus one per gender
+class PatientStats:
+
+    def __init__(self):
+        self.total = SummaryGroup()
+        self.by_gender = {}
+
+    def build(self, data):
+        self.total = SummaryGroup()
+        self.by_gender = {}
+        for record in data.values():
+            self.add(record)
+
+    def add(self, record):
+        self.total.add(record)
+        self.by_gender.setdefault(record.get('gender'), SummaryGroup()).add(record)
+
+    def remove(self, record):
+        self.total.remove(record)
+        group = self.by_gender.get(record.get('gender'))
+        if group is not None:
+            group.remove(record)
+            if group.count == 0:
+                del self.by_gender[record.get('gender')]
+
+    def merge(self, other):
+        self.total.merge(other.total)
+        for gender, group in other.by_gender.items():
+            self.by_gender.setdefault(gender, SummaryGroup()).merge(group)
+
+    def copy(self):
+        stats = PatientStats()
+        stats.merge(self)
+        return stats
+
+    def summary(self, group_by=None, percentiles=(50, 90, 99)):
+        result = self.total.summary(percentiles)
+        if group_by == 'gender':
+            result['by_gender'] = {str(gender): group.summary(percentiles) for gender, group in self.by_gender.items()}
+        return result
+
+
+# the same summary computed from the records themselves, with exact percentiles (linear interpolation).
+# numbers are gathered into one NumPy array per field and group, without NumPy plain python is used
+def exact_summary(records, group_by=None, percentiles=(50, 90, 99)):
+    records = list(records)
+    result = _exact_group(records, percentiles)
+    if group_by == 'gender':
+        groups = {}
+        for record in records:
+            groups.setdefault(record.get('gender'), []).append(record)
+        result['by_gender'] = {str(gender): _exact_group(group, percentiles) for gender, group in groups.items()}
+    return result
+
+
+def _exact_group(records, percentiles):
+    counts = {field: {} for field in COUNT_FIELDS}
+    for record in records:
+        for field, field_counts in counts.items():
+            value = record.get(field)
+            field_counts[value] = field_counts.get(value, 0) + 1
+    fields = {}
+    for field in STAT_FIELDS:
+        values = [value for value in (_number(record.get(field)) for record in records) if value is not None]
+        fields[field] = {'count': len(values), **_exact_moments(values, percentiles)}
+    return _group_summary(len(records), counts, fields)
+
+
+def _exact_moments(values, percentiles):
+    if not values:
+        return {'mean': None, 'std': None, **{f'p{p:g}': None for p in percentiles}}
+    np = numpy_or_none()
+    if np is not None:
+        array = np.asarray(values, dtype=np.float64)
+        quantiles = np.percentile(array, percentiles).tolist()
+        return {'mean': float(array.mean()), 'std': float(array.std()),
+                **{f'p{p:g}': value for p, value in zip(percentiles, quantiles)}}
+
+    ordered = sorted(values)
+    mean = math.fsum(ordered) / len(ordered)
+    std = math.sqrt(math.fsum((value - mean) ** 2 for value in ordered) / len(ordered))
+    return {'mean': mean, 'std': std, **{f'p{p:g}': _interpolate(ordered, p / 100) for p in percentiles}}
+
+
+def _interpolate(ordered, q):
+    position = q * (len(ordered) - 1)
+    low = math.floor(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
@@ -0,0 +1,517 @@
+import json
+import marshal
+import os
+import queue
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+from itertools import groupby
+
+
+# a storage backend is what PatientStore persists through, there are two of them:
+#   PatientJournal - patients.json snapshot + append-only log (the default)
+#   SqliteBackend  - a SQLite database in WAL mode
+# both offer the same methods: load(), append(entries) -> ticket, sync(ticket), needs_compaction(count),
+# start_compaction(data_copy), write_snapshot(data), snapshot_changed() and close().
+# an entry is either {'op': 'put', 'id': ..., 'record': {...}} with the whole record, or
+# {'op': 'patch', 'id': ..., 'changes': {...}} with only the fields that changed, apply_entry() applies it to an in-memory dict.
+#
+# entries also carry the 'seq' number the change feed gave them (see changefeed.py). after load() a backend knows
+# the last number it has stored (last_seq) and the oldest position changes_since(seq) can still answer (first_seq),
+# changes_since returns the stored entries after that position in order, or None when it cannot.
+def apply_entry(data, entry):
+    if entry['op'] == 'put':
+        data[entry['id']] = entry['record']
+    elif entry['op'] == 'patch':
+        # the patient can be missing when an outside edit of the snapshot removed it after the patch was logged,
+        # there is no record left to apply the changes to then, so the patch is skipped
+        record = data.get(entry['id'])
+        if record is not None:
+            data[entry['id']] = {**record, **entry['changes']}
+
+
+# the backend is picked through configuration:
+#   PATIENT_STORAGE=json (default) or sqlite
+#   PATIENT_DATA_PATH=patients.json, or patients.db for sqlite
+# with `shard` set the backend of that shard is returned instead, it lives next to the unsharded data (see shard_path)
+def backend_from_env(environ=os.environ, shard=None):
+    path = data_path_from_env(environ, shard)
+    if environ.get('PATIENT_STORAGE', 'json') == 'json':
+        return PatientJournal(path)
+    return SqliteBackend(path)
+
+
+def data_path_from_env(environ=os.environ, shard=None):
+    kind = environ.get('PATIENT_STORAGE', 'json')
+    if kind not in ('json', 'sqlite'):
+        raise ValueError(f'Unknown PATIENT_STORAGE {kind!r}, expected json or sqlite')
+    path = environ.get('PATIENT_DATA_PATH', 'patients.json' if kind == 'json' else 'patients.db')
+    return path if shard is None else shard_path(path, shard)
+
+
+# patients.json -> patients.shard0.json, patients.db -> patients.shard0.db
+def shard_path(path, shard):
+    root, ext = os.path.splitext(path)
+    return f'{root}.shard{shard}{ext}'
+
+
+# PatientJournal is the default storage engine behind PatientStore.
+# instead of rewriting the whole patients.json on every create or edit, each mutation is appended as one line to a
+# write-ahead log (patients.json.log), so a single write costs the same no matter how many patients there are.
+# patients.json itself becomes a snapshot: every now and then the log is compacted into a new snapshot which is
+# written to a temporary file and atomically renamed over the old one.
+# on startup the state is rebuilt from the snapshot plus whatever is left in the log.
+#
+# every log line looks like '<crc32 of payload> <json payload>\n', a line with a bad checksum or without the
+# trailing newline is what a crash in the middle of a write leaves behind, replay stops there and the tail is cut off.
+#
+# parsing a large patients.json dominates a restart, so every snapshot is also kept in marshal format
+# (patients.json.bin), which loads about twice as fast. it is only a cache: it records the (inode, mtime, size)
+# of the snapshot it was made from and is ignored as soon as patients.json is different, unreadable, or written
+# by another Python version, the JSON file stays the source of truth.
+class PatientJournal:
+
+    def __init__(self, path='patients.json', compact_min_entries=1000, binary_snapshot=True):
+        self.path = path
+        self.binary_path = path + '.bin' if binary_snapshot else None
+        self.log_path = path + '.log'
+        # while a compaction is running the previous log is parked here until the new snapshot is in place
+        self.old_log_path = path + '.log.1'
+        self.compact_min_entries = compact_min_entries
+        self._append_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._log = None
+        self._written = 0       # number of entries handed to the OS
+        self._synced = 0        # number of entries known to be on disk
+        self._log_entries = 0   # entries in the current log, used to decide when to compact
+        self._compacting = False
+        self._compaction_thread = None
+        self._snapshot_id = None
+        self.last_seq = 0
+        self.first_seq = 0
+        # the sequence number in the marker that starts the log of a running compaction
+        self._rotated_seq = 0
+
+    # ---- recovery ----
+
+    # (inode, mtime, size) of the snapshot, refreshed after every snapshot we write ourselves
+    def _stat_snapshot(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    # True when patients.json was replaced or edited by someone other than this journal
+    def snapshot_changed(self):
+        if self._compacting:
+            return False
+        return self._stat_snapshot() != self._snapshot_id
+
+    # rebuild the state from snapshot + logs, it can be called again to pick up an outside edit of the snapshot,
+    # acknowledged writes that are still in the log are replayed on top of the edited file, never dropped
+    # (except patches of patients the edit removed, see apply_entry)
+    # everything is read into a new dict first and the journal's own state is only touched once that succeeded,
+    # so a snapshot that cannot be parsed (an editor that is still writing it) fails the reload, but the log stays
+    # open and writes keep working. the log handle is kept across reloads, a writer may be fsyncing it right now
+    def load(self):
+        self._wait_for_compaction()
+        data = {}
+        seqs = {'first': None, 'last': self.last_seq, 'unnumbered': False}
+        snapshot_id = self._stat_snapshot()
+        if snapshot_id is not None:
+            data = self._read_snapshot(snapshot_id)
+
+        leftover = os.path.exists(self.old_log_path)
+        if leftover:
+            self._replay(self.old_log_path, data, seqs)
+        log_entries = self._replay(self.log_path, data, seqs)
+
+        with self._sync_lock, self._append_lock:
+            self._snapshot_id = snapshot_id
+            self._log_entries = log_entries
+            self.last_seq = seqs['last']
+            if seqs['first'] is None or seqs['unnumbered']:
+                # nothing has been compacted since sequence numbers were introduced, or the log is older than them
+                self.first_seq = seqs['last'] if seqs['unnumbered'] else 0
+            else:
+                self.first_seq = seqs['first']
+            if self._log is None:
+                self._open_log()
+        if leftover:
+            # a compaction was interrupted, finish it now before accepting new writes
+            self.write_snapshot(data)
+        return data
+
+    def _read_snapshot(self, snapshot_id):
+        data = self._read_binary(snapshot_id)
+        if data is None:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self._write_binary(data, snapshot_id)
+        return data
+
+    def _read_binary(self, snapshot_id):
+        if self.binary_path is None:
+            return None
+        try:
+            # marshal.load() on a file object reads it in small pieces and is slower than json.load,
+            # reading the whole file first and using marshal.loads() is what makes the cache fast
+            with open(self.binary_path, 'rb') as f:
+                cached_id, data = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return data if cached_id == snapshot_id else None
+
+    # no fsync, a cache that did not make it to disk is simply rebuilt from the JSON snapshot on the next start.
+    # a columnar table (see columnar.py) is not cached here, load() writes the cache from the parsed JSON instead
+    def _write_binary(self, data, snapshot_id):
+        if self.binary_path is None or not isinstance(data, dict):
+            return
+        tmp_path = self.binary_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(marshal.dumps((snapshot_id, data)))
+        os.replace(tmp_path, self.binary_path)
+
+    def _replay(self, log_path, data, seqs):
+        if not os.path.exists(log_path):
+            return 0
+        count = 0
+        good_offset = 0
+        with open(log_path, 'rb') as f:
+            for line in f:
+                entry = self._decode(line)
+                if entry is None:
+                    break
+                apply_entry(data, entry)
+                self._track_seq(entry, seqs)
+                good_offset += len(line)
+                count += 1
+        # drop a torn tail so new entries are not appended after garbage
+        if good_offset != os.path.getsize(log_path):
+            with open(log_path, 'r+b') as f:
+                f.truncate(good_offset)
+                os.fsync(f.fileno())
+        return count
+
+    # every log written by a compaction or a full snapshot starts with a {'op': 'seq'} marker holding the last sequence
+    # number at that moment, the changes up to it are only in the snapshot, the ones after it are all in the log
+    @staticmethod
+    def _track_seq(entry, seqs):
+        seq = entry.get('seq')
+        if seq is None:
+            seqs['unnumbered'] = True
+            return
+        if seqs['first'] is None:
+            seqs['first'] = seq if entry['op'] == 'seq' else 0
+        seqs['last'] = max(seqs['last'], seq)
+
+    # the logged entries after `seq` in sequence order, None if some of them are only left in the snapshot.
+    # both logs are opened under the append lock, so a compaction cannot rotate them in between,
+    # an open file can still be read after it was renamed or removed
+    def changes_since(self, seq):
+        with self._append_lock:
+            if seq < self.first_seq:
+                return None
+            files = [open(path, 'rb') for path in (self.old_log_path, self.log_path) if os.path.exists(path)]
+        changes = []
+        for f in files:
+            with f:
+                for line in f:
+                    entry = self._decode(line)
+                    if entry is None:
+                        break
+                    if entry['op'] != 'seq' and entry.get('seq', 0) > seq:
+                        changes.append(entry)
+        # concurrent writers append in the order their appends ran, not in the order they got their numbers
+        changes.sort(key=lambda entry: entry['seq'])
+        return changes
+
+    @staticmethod
+    def _decode(line):
+        if not line.endswith(b'\n'):
+            return None
+        crc, _, payload = line.rstrip(b'\n').partition(b' ')
+        try:
+            if int(crc, 16) != zlib.crc32(payload):
+                return None
+            return json.loads(payload)
+        except ValueError:
+            return None
+
+    # entries are idempotent (they carry the full record), so replaying one twice is harmless
+    @staticmethod
+    def _encode(entry):
+        payload = json.dumps(entry, separators=(',', ':')).encode()
+        return b'%08x %s\n' % (zlib.crc32(payload), payload)
+
+    # ---- writing ----
+
+    def _open_log(self):
+        self._log = open(self.log_path, 'ab')
+
+    # called with the append lock held right after a new log was started, fsynced because the sequence numbers
+    # of everything before it are lost from the log from now on
+    def _write_seq_marker(self):
+        self._log.write(self._encode({'op': 'seq', 'seq': self.last_seq}))
+        self._log.flush()
+        os.fsync(self._log.fileno())
+
+    # append entries to the log and return a ticket for sync(),
+    # the caller applies the same entries to its in-memory state while it still holds its own lock
+    def append(self, entries):
+        chunk = b''.join(self._encode(entry) for entry in entries)
+        with self._append_lock:
+            self._log.write(chunk)
+            self._log.flush()
+            self._written += len(entries)
+            self._log_entries += len(entries)
+            self.last_seq = max(self.last_seq, entries[-1].get('seq', 0))
+            return self._written
+
+    # group commit: whichever writer gets the sync lock first fsyncs the log for everyone who appended before it,
+    # the writers queued behind it find their entries already on disk and return without another fsync
+    def sync(self, ticket):
+        if self._synced >= ticket:
+            return
+        with self._sync_lock:
+            if self._synced >= ticket:
+                return
+            with self._append_lock:
+                target = self._written
+                fd = self._log.fileno()
+            os.fsync(fd)
+            self._synced = max(self._synced, target)
+
+    # ---- compaction ----
+
+    def needs_compaction(self, record_count):
+        if self._compacting or os.path.exists(self.old_log_path):
+            return False
+        # compacting once the log holds about half as many entries as there are records keeps the amortised
+        # cost of a snapshot constant per write, and the log never grows much beyond the snapshot itself
+        return self._log_entries > max(self.compact_min_entries, record_count // 2)
+
+    # called by the store while it blocks writers: the current log is parked as .log.1 and a fresh one is started,
+    # the snapshot itself is written from the given copy of the data in a background thread
+    def start_compaction(self, data_copy):
+        with self._sync_lock, self._append_lock:
+            self._compacting = True
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._log.close()
+            os.replace(self.log_path, self.old_log_path)
+            self._synced = self._written
+            self._log_entries = 0
+            self._open_log()
+            self._rotated_seq = self.last_seq
+            self._write_seq_marker()
+        self._compaction_thread = threading.Thread(target=self._finish_compaction, args=(data_copy,), daemon=True)
+        self._compaction_thread.start()
+        return self._compaction_thread
+
+    def _finish_compaction(self, data_copy):
+        try:
+            self._write_snapshot_file(data_copy)
+            with self._append_lock:
+                os.remove(self.old_log_path)
+                self.first_seq = self._rotated_seq
+        finally:
+            self._compacting = False
+
+    def _write_snapshot_file(self, data):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            if isinstance(data, dict):
+                json.dump(data, f)
+            else:
+                # a columnar table (see columnar.py) is written one record at a time instead of being turned into a dict first
+                f.write('{')
+                for i, (patient_id, record) in enumerate(data.items()):
+                    f.write('%s%s: %s' % (', ' if i else '', json.dumps(patient_id), json.dumps(record)))
+                f.write('}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._snapshot_id = self._stat_snapshot()
+        self._write_binary(data, self._snapshot_id)
+        # make the rename itself durable
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    # synchronous full snapshot, used by replace_all and by recovery, both logs are empty afterwards
+    def write_snapshot(self, data):
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+        with self._sync_lock, self._append_lock:
+            self._write_snapshot_file(data)
+            self._log.close()
+            self._log = open(self.log_path, 'wb')
+            self._write_seq_marker()
+            if os.path.exists(self.old_log_path):
+                os.remove(self.old_log_path)
+            self.first_seq = self.last_seq
+            self._synced = self._written
+            self._log_entries = 0
+
+    # let a running compaction finish, otherwise a load could find a half-renamed log
+    def _wait_for_compaction(self):
+        thread = self._compaction_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def close(self):
+        self._wait_for_compaction()
+        with self._sync_lock, self._append_lock:
+            if self._log is not None:
+                self._log.flush()
+                os.fsync(self._log.fileno())
+                self._log.close()
+                self._log = None
+
+
+# SqliteBackend stores one row per patient, with a column per Patient field so the data can be queried and indexed
+# in SQL as well (indexes on city, bmi, height and weight, the id is the primary key).
+# the database runs in WAL mode, so readers never block the writer and a commit is a single append to the WAL file.
+# SQLite allows only one writer at a time anyway, so all writes go through one connection guarded by a lock,
+# reads (loading the data set) borrow a connection from a small pool. each connection caches its prepared statements,
+# the same INSERT is compiled once and reused for every write.
+class SqliteBackend:
+
+    columns = ('name', 'city', 'age', 'gender', 'height', 'weight', 'bmi', 'verdict')
+
+    def __init__(self, path='patients.db', pool_size=4, synchronous='NORMAL'):
+        self.path = path
+        # NORMAL is crash-safe in WAL mode (a power loss can only lose the last commits), FULL also survives that
+        self.synchronous = synchronous
+        self._pool = queue.Queue()
+        for _ in range(pool_size):
+            self._pool.put(self._connect())
+        self._writer = self._connect()
+        self._write_lock = threading.Lock()
+        self._writer.executescript("""
+            CREATE TABLE IF NOT EXISTS patients (
+                id TEXT PRIMARY KEY,
+                name TEXT, city TEXT, age INTEGER, gender TEXT,
+                height REAL, weight REAL, bmi REAL, verdict TEXT
+            );
+            CREATE INDEX IF NOT EXISTS patients_city ON patients (city);
+            CREATE INDEX IF NOT EXISTS patients_bmi ON patients (bmi);
+            CREATE INDEX IF NOT EXISTS patients_height ON patients (height);
+            CREATE INDEX IF NOT EXISTS patients_weight ON patients (weight);
+        """)
+        self._upsert = 'INSERT OR REPLACE INTO patients (id, %s) VALUES (?, %s)' % (
+            ', '.join(self.columns), ', '.join('?' * len(self.columns)))
+        self._data_version = None
+        # the last sequence number is kept in the database header (PRAGMA user_version, a 32 bit integer) and updated
+        # in the same transaction as the rows. there is no log of past entries, so only the change feed's in-memory
+        # buffer can serve positions, changes_since() never can
+        self.last_seq = 0
+        self.first_seq = 0
+
+    def _connect(self):
+        # the connections are shared between threads of FastAPI's threadpool, the pool and the write lock make sure
+        # a connection is only used by one thread at a time
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, cached_statements=64)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        return conn
+
+    @contextmanager
+    def _reader(self):
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    def _row(self, entry):
+        record = entry['record']
+        return (entry['id'], *[record.get(column) for column in self.columns])
+
+    # (sql, parameters) for an entry, a patch only updates the columns it changes (None when it changes none of them)
+    def _statement(self, entry):
+        if entry['op'] == 'put':
+            return self._upsert, self._row(entry)
+        columns = [column for column in self.columns if column in entry['changes']]
+        if not columns:
+            return None
+        sql = 'UPDATE patients SET %s WHERE id = ?' % ', '.join(f'{column} = ?' for column in columns)
+        return sql, (*[entry['changes'][column] for column in columns], entry['id'])
+
+    # PRAGMA data_version on the writer connection only changes when *another* connection committed,
+    # which is exactly an edit made outside of this process
+    def _current_data_version(self):
+        with self._write_lock:
+            return self._writer.execute('PRAGMA data_version').fetchone()[0]
+
+    def snapshot_changed(self):
+        return self._current_data_version() != self._data_version
+
+    def load(self):
+        data = {}
+        with self._reader() as conn:
+            for row in conn.execute('SELECT id, %s FROM patients' % ', '.join(self.columns)):
+                data[row[0]] = {column: value for column, value in zip(self.columns, row[1:]) if value is not None}
+            self.last_seq = max(self.last_seq, conn.execute('PRAGMA user_version').fetchone()[0])
+        self.first_seq = self.last_seq
+        self._data_version = self._current_data_version()
+        return data
+
+    # every append is its own transaction, so the rows are durable once it returns and sync() has nothing to do
+    def append(self, entries):
+        statements = [statement for statement in map(self._statement, entries) if statement is not None]
+        seq = entries[-1].get('seq') if entries else None
+        with self._write_lock:
+            # appends can arrive out of sequence order (see changefeed.py), the stored number never goes back
+            if seq is not None:
+                seq = max(seq, self.last_seq)
+            self._writer.execute('BEGIN IMMEDIATE')
+            try:
+                # runs of entries with the same statement (all puts, patches of the same fields) go in one executemany
+                for sql, group in groupby(statements, key=lambda statement: statement[0]):
+                    self._writer.executemany(sql, [parameters for _, parameters in group])
+                if seq is not None:
+                    self._writer.execute(f'PRAGMA user_version = {int(seq)}')
+                self._writer.execute('COMMIT')
+            except BaseException:
+                self._writer.execute('ROLLBACK')
+                raise
+            if seq is not None:
+                self.last_seq = seq
+        return len(entries)
+
+    def sync(self, ticket):
+        pass
+
+    def changes_since(self, seq):
+        return None
+
+    # SQLite checkpoints its WAL into the database file by itself
+    def needs_compaction(self, record_count):
+        return False
+
+    def start_compaction(self, data_copy):
+        pass
+
+    def write_snapshot(self, data):
+        rows = [self._row({'id': patient_id, 'record': record}) for patient_id, record in data.items()]
+        with self._write_lock:
+            self._writer.execute('BEGIN IMMEDIATE')
+            try:
+                self._writer.execute('DELETE FROM patients')
+                self._writer.executemany(self._upsert, rows)
+                self._writer.execute('COMMIT')
+            except BaseException:
+                self._writer.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        with self._write_lock:
+            self._writer.close()
+        while not self._pool.empty():
+            self._pool.get().close()
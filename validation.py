@@ -0,0 +1,78 @@
+from functools import lru_cache
+from typing import Annotated
+
+from pydantic import TypeAdapter, ValidationError
+
+
+# batch validation for anything that takes in many records at once (bulk import, data migration, benchmarks).
+# Model(**item) in a loop goes through the python-level __init__ and the validator entry point once per record,
+# a TypeAdapter(list[Model]) validates the whole batch in a single call into pydantic-core.
+# building a TypeAdapter compiles a validator, so there is exactly one per model for the whole process.
+@lru_cache(maxsize=None)
+def list_adapter(model):
+    return TypeAdapter(list[model])
+
+
+# validate `items` with one list_adapter(model) call per batch instead of one model(**item) per record.
+# a failing batch is validated once more without the items that caused errors, so the good ones are still returned.
+# yields (index, model instance) for valid items and collects {'index', 'errors'} for the rest in `errors`.
+# strict=True turns off type coercion ('30' is no longer accepted for an int), which is also a little faster
+def validate_in_batches(model, items, errors, batch_size=1000, strict=False):
+    adapter = list_adapter(model)
+    skip = {error['index'] for error in errors}
+    for start in range(0, len(items), batch_size):
+        indexes = [i for i in range(start, min(start + batch_size, len(items))) if i not in skip]
+        batch = [items[i] for i in indexes]
+        try:
+            validated = adapter.validate_python(batch, strict=strict)
+        except ValidationError as exc:
+            failed = {}
+            for error in exc.errors(include_url=False, include_context=False):
+                position, *field = error['loc']
+                failed.setdefault(position, []).append({'loc': field, 'msg': error['msg'], 'type': error['type']})
+            for position, details in failed.items():
+                errors.append({'index': indexes[position], 'errors': details})
+            indexes = [index for position, index in enumerate(indexes) if position not in failed]
+            validated = adapter.validate_python([items[i] for i in indexes], strict=strict)
+        yield from zip(indexes, validated)
+
+
+# all valid instances plus the errors of the invalid items, in input order
+def validate_many(model, items, batch_size=1000, strict=False):
+    errors = []
+    instances = [instance for _, instance in validate_in_batches(model, items, errors, batch_size, strict)]
+    return instances, errors
+
+
+# instances built without any validation, only for data that has already been validated before
+# (records read back from the store, data this process wrote itself), never for client input.
+# model_construct runs in python, for a model with only simple fields it is no faster than batch validation in
+# pydantic-core, it pays off when validation is expensive (EmailStr, python field validators, nested models)
+def construct_many(model, items):
+    return [model.model_construct(**item) for item in items]
+
+
+# one TypeAdapter per field of `model`, built from the field's annotation and constraints (gt=0, Literal[...], ...),
+# so a partial update can check only the fields it carries against exactly the rules the full model applies
+@lru_cache(maxsize=None)
+def field_adapters(model):
+    return {name: TypeAdapter(Annotated[field.annotation, *field.metadata] if field.metadata else field.annotation)
+            for name, field in model.model_fields.items()}
+
+
+# validate the given fields of a partial record, returns the validated values and a list of
+# {'loc', 'msg', 'type'} errors (fields that the model does not have are reported as well)
+def validate_fields(model, values, strict=False):
+    adapters = field_adapters(model)
+    validated, errors = {}, []
+    for name, value in values.items():
+        adapter = adapters.get(name)
+        if adapter is None:
+            errors.append({'loc': [name], 'msg': 'Unknown field', 'type': 'extra_forbidden'})
+            continue
+        try:
+            validated[name] = adapter.validate_python(value, strict=strict)
+        except ValidationError as exc:
+            errors.extend({'loc': [name, *error['loc']], 'msg': error['msg'], 'type': error['type']}
+                          for error in exc.errors(include_url=False, include_context=False))
+    return validated, errors